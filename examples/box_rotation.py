@@ -25,14 +25,13 @@ zc = 'w'
 zls = '--'
 zlw = 1.5
 
-count = 0
-for theta in np.linspace(0,2*np.pi, 250):
-    view = [('y',theta)]
-    imlist = []
-    for scale in ['5592pc', '1000pc', '10pc', '100pc']:
-        imlist.append(pyGadget.visualize.project(snap, 'ndensity', 
-                                                 scale, view, centering='avg'))
-
+# Particles are loaded and centered once; frames are rendered in parallel
+# and handed back in order as they finish.
+sequence = pyGadget.visualize.RotationSequence(snap,
+                                               ['5592pc', '1000pc', '10pc', '100pc'],
+                                               np.linspace(0,2*np.pi, 250),
+                                               axis='y', centering='avg')
+for count, imlist in sequence.frames():
     fig = plt.figure(1, (12., 12.), dpi=600)
     grid = ImageGrid(fig, 111, # similar to subplot(111)
                     nrows_ncols = (2, 2), # creates 2x2 grid of axes
@@ -41,9 +40,7 @@ for theta in np.linspace(0,2*np.pi, 250):
                     )
 
     for i in range(4):
-        x = imlist[i][0]
-        y = imlist[i][1]
-        im = imlist[i][2]
+        im = imlist[i]
         ax = grid[i]
         img = ax.imshow(im, cmap=plt.cm.bone, origin='lower')
         ax.xaxis.set_visible(False)
@@ -83,4 +80,4 @@ for theta in np.linspace(0,2*np.pi, 250):
 
     fig.savefig(sim.plotpath+'/'+sim.name+'/rotations/box/{:0>4}-zoom.png'.format(count), 
                 bbox_inches='tight', dpi=100)
-    count += 1
+    plt.close(fig)
@@ -7,7 +7,8 @@ import numpy
 from pandas import Series, DataFrame
 
 import gadfly as gdf
-from gadfly import units
+from gadfly import units, constants
+from gadfly.hdf5 import derived_field
 
 
 class PartTypeCustom(gdf.nbody.PartTypeNbody):
@@ -15,6 +16,10 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
     Class for SPH particles.
     Extends: nbody.PartTypeNbody
     """
+    # Chemical Abundances--> 0:H2I 1:HII 2:DII 3:HDI 4:HeII 5:HeIII
+    _vector_columns = dict(gdf.nbody.PartTypeNbody._vector_columns,
+                           abundances=['H2', 'HII', 'DII', 'HD', 'HeII', 'HeIII'])
+
     def __init__(self, file_id, ptype, sim, **kwargs):
         kwargs.pop('refine_nbody', None)
         super(gdf.nbody.PartTypeNbody,self).__init__(file_id, ptype, sim, **kwargs)
@@ -49,25 +54,16 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
     def __init_load_dict__(self):
         super(PartTypeCustom,self).__init_load_dict__()
         sph_loaders = {'density':self.get_density,
-                       'ndensity':self.get_number_density,
                        'internal_energy':self.get_internal_energy,
                        'adiabatic_index':self.get_adiabatic_index,
                        'abundances':self.get_abundances,
                        'sink_value':self.get_sinks,
                        'smoothing_length':self.get_smoothing_length
                        }
-        sph_derived = {'h2frac':self.get_H2_fraction,
-                       'HDfrac':self.get_HD_fraction,
-                       'electron_frac':self.get_electron_fraction,
-                       'temp':self.get_temperature,
-                       'c_s':self.get_sound_speed,
-                       't_ff':self.get_freefall_time,
-                       'jeans_length':self.get_jeans_length
-                       }
+        # Derived fields (ndensity, h2frac, temperature, jeans_length, ...)
+        # are registered with the derived_field decorator below.
         self._load_dict.update(sph_loaders)
-        self._load_dict.update(sph_derived)
         self.loadable_keys = self._load_dict.keys()
-        self._calculated.append(sph_derived.keys())
 
     def refine_dataset(self, *keys, **kwargs):
         if len(keys) < 1:
@@ -76,7 +72,7 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         criterion = kwargs.pop('criterion', None)
         if criterion is None:
             criterion = (self.masses > self.masses.min()) & (self.sink_value == 0.)
-        super(PartTypeNbody, self).refine_dataset(criterion)
+        super(gdf.nbody.PartTypeNbody, self).refine_dataset(criterion)
 
     def load_density(self, unit=None):
         """
@@ -85,18 +81,8 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         """
         if unit:
             self.units.set_density(unit)
-        density = self._density.value * self.units.density_conv
-        if self.units.remove_h:
-            h = self._header.HubbleParam
-            density *=  h**2
-        if self.units.coordinate_system == 'physical':
-            ainv = self._header.Redshift + 1 # 1/(scale factor)
-            density *= ainv**3
-        if self._drop_ids is not None:
-            density = Series(density, index=self._particleIDs.value)
-            self['density'] = density.drop(self._drop_ids)
-        else:
-            self['density'] = density
+        density = self._read_field('density')
+        self._set_field('density', density)
 
     def get_density(self, unit=None):
         """
@@ -112,40 +98,18 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
             self.load_density(unit)
             return self.density
 
-    def load_number_density(self, unit=None):
+    @derived_field('ndensity', 'density', units=['density_unit'])
+    def calculate_number_density(self):
         """
-        Load Particle Number Densities in cgs units (default set in units class)
-        unit: unit conversion from code units
+        Calculate Particle Number Densities in particles/cc.
         """
-        if unit:
-            self.units.set_density(unit)
-        ndensity = self._density.value * self.units.density_conv \
-                   * constants.X_h / constants.m_H
-        if self.units.remove_h:
-            h = self._header.HubbleParam
-            ndensity *=  h**2
-        if self.units.coordinate_system == 'physical':
-            ainv = self._header.Redshift + 1 # 1/(scale factor)
-            ndensity *= ainv**3
-        if self._drop_ids is not None:
-            ndensity = Series(ndensity, index=self._particleIDs.value)
-            self['ndensity'] = ndensity.drop(self._drop_ids)
-        else:
-            self['ndensity'] = ndensity
+        return self.density * constants.X_h / constants.m_H
 
-    def get_number_density(self, unit=None):
+    def get_number_density(self):
         """
-        Return Particle Densities in cgs units (default set in units class)
-        unit: unit conversion from code units
+        Return Particle Number Densities in particles/cc.
         """
-        if unit:
-            if unit != self.units.density_unit:
-                self.load_number_density(unit)
-        try:
-            return self.ndensity
-        except AttributeError:
-            self.load_number_density(unit)
-            return self.ndensity
+        return self.get_derived('ndensity')
 
     def load_internal_energy(self, unit=None):
         """
@@ -155,12 +119,8 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         """
         if unit:
             self.units.set_energy(unit)
-        energy = self._internal_energy.value * self.units.energy_conv
-        if self._drop_ids is not None:
-            energy = Series(energy, index=self._particleIDs.value)
-            self['internal_energy'] = energy.drop(self._drop_ids)
-        else:
-            self['internal_energy'] = energy
+        energy = self._read_field('internal_energy')
+        self._set_field('internal_energy', energy)
 
     def get_internal_energy(self, unit=None):
         """
@@ -180,12 +140,8 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         """
         Load particle adiabatic index.
         """
-        gamma = self._Adiabatic_index.value
-        if self._drop_ids is not None:
-            gamma = Series(gamma, index=self._particleIDs.value)
-            self['adiabatic_index'] = gamma.drop(self._drop_ids)
-        else:
-            self['adiabatic_index'] = gamma
+        gamma = self._read_dataset(self._Adiabatic_index)
+        self._set_field('adiabatic_index', gamma)
 
     def get_adiabatic_index(self):
         """
@@ -205,18 +161,8 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         """
         if unit:
             self.units._set_smoothing_length(unit)
-        hsml = self._smoothing_length.value * self.units.length_conv
-        if self.units.remove_h:
-            h = self._header.HubbleParam
-            hsml /= h
-        if self.units.coordinate_system == 'physical':
-            a = self._header.ScaleFactor
-            hsml *= a
-        if self._drop_ids is not None:
-            hsml = Series(hsml, index=self._particleIDs.value)
-            self['smoothing_length'] = hsml.drop(self._drop_ids)
-        else:
-            self['smoothing_length'] = hsml
+        hsml = self._read_field('smoothing_length')
+        self._set_field('smoothing_length', hsml)
 
     def get_smoothing_length(self, unit=None):
         """
@@ -237,12 +183,8 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         """
         Load particle by particle sink flag values.
         """
-        sinks = self._sink_value.value
-        if self._drop_ids is not None:
-            sinks = Series(sinks, index=self._particleIDs.value)
-            self['sink_value'] = sinks.drop(self._drop_ids)
-        else:
-            self['sink_value'] = sinks
+        sinks = self._read_dataset(self._sink_value)
+        self._set_field('sink_value', sinks)
 
     def get_sinks(self):
         """
@@ -264,12 +206,8 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
         default_species = ['H2', 'HII', 'DII', 'HD', 'HeII', 'HeIII']
         if tracked_species is None:
             tracked_species = default_species
-        abundances = self._ChemicalAbundances.value
-        abundances = DataFrame(abundances, index=self._particleIDs.value,
-                               columns=tracked_species)
-        if self._drop_ids is not None:
-            abundances.drop(self._drop_ids)
-        self[tracked_species] = abundances
+        abundances = self._read_dataset(self._ChemicalAbundances)
+        self._set_field(list(tracked_species), abundances)
 
     def get_abundances(self, *species, **kwargs):
         """
@@ -293,130 +231,105 @@ class PartTypeCustom(gdf.nbody.PartTypeNbody):
                 self.load_abundances(**kwargs)
                 return self[list(species)]
 
+    @derived_field('electron_fraction', 'HII', 'DII', 'HeII', 'HeIII')
     def calculate_electron_fraction(self):
         """
         Calculate the free electron fraction.
         """
-        # Chemical Abundances--> 0:H2I 1:HII 2:DII 3:HDI 4:HeII 5:HeIII
-        abundances = self.get_abundances('HII', 'DII', 'HeII', 'HeIII')
-        self['electron_fraction'] = abundances.HII + abundances.DII \
-                                    + abundances.HeII + 2*abundances.HeIII
+        return self.HII + self.DII + self.HeII + 2*self.HeIII
 
     def get_electron_fraction(self):
         """
         Return the free electron fraction.
         """
-        try:
-            return self.electron_fraction
-        except AttributeError:
-            self.calculate_electron_fraction()
-            return self.electron_fraction
+        return self.get_derived('electron_fraction')
 
+    @derived_field('h2frac', 'H2')
     def calculate_H2_fraction(self):
         """
         Calculate the molecular hydrogen fraction.
         """
-        self['h2frac'] = 2 * self.get_abundances('H2')
+        return 2 * self.H2
 
     def get_H2_fraction(self):
         """
         Return the molecular hydrogen fraction.
         """
-        try:
-            return self.h2frac
-        except AttributeError:
-            self.calculate_H2_fraction()
-            return self.h2frac
+        return self.get_derived('h2frac')
 
+    @derived_field('HDfrac', 'HD')
     def calculate_HD_fraction(self):
         """
         Calculate the molecular HD fraction.
         """
-        self['HDfrac'] = 2 * self.get_abundances('HD')
+        return 2 * self.HD
 
     def get_HD_fraction(self):
         """
         Return the molecular HD fraction.
         """
-        try:
-            return self.HDfrac
-        except AttributeError:
-            self.calculate_HD_fraction()
-            return self.HDfrac
+        return self.get_derived('HDfrac')
 
+    def _mean_molecular_weight(self):
+        h2frac = self.h2frac
+        mu = (0.24/4.0) + ((1.0-h2frac)*0.76) + (h2frac*.76/2.0)
+        return 1 / mu
+
+    @derived_field('temperature', 'adiabatic_index', 'internal_energy',
+                   'h2frac')
     def calculate_temperature(self):
         """
         Calculate Particle Temperatures in degrees Kelvin.
         """
-        gamma = self.get_adiabatic_index()
         energy = self.get_internal_energy('specific cgs')
-        h2frac = self.get_H2_fraction()
-        mu = (0.24/4.0) + ((1.0-h2frac)*0.76) + (h2frac*.76/2.0)
-        mu = 1 / mu # mean molecular weight
-        self['temperature'] = (mu * 1.6726e-24 / 1.3806e-16) * energy * (gamma-1)
+        mu = self._mean_molecular_weight()
+        return (mu * constants.m_H / constants.k_B) * energy \
+            * (self.adiabatic_index - 1)
 
     def get_temperature(self):
         """
         Return Particle Temperatures in degrees Kelvin.
         """
-        try:
-            return self.temperature
-        except AttributeError:
-            self.calculate_temperature()
-            return self.temperature
+        return self.get_derived('temperature')
 
+    @derived_field('c_s', 'temperature', 'h2frac')
     def calculate_sound_speed(self):
         """
         Calculate the sound speed of the gas in cm/s.
         """
-        temp = self.get_temperature()
-        h2frac = self.get_H2_fraction()
-        mu = (0.24/4.0) + ((1.0-h2frac)*0.76) + (h2frac*.76/2.0)
-        mu = 1 / mu # mean molecular weight
-        self.c_s = numpy.sqrt(constants.k_B*temp/(mu*constants.m_H))
+        mu = self._mean_molecular_weight()
+        return numpy.sqrt(constants.k_B * self.temperature / (mu*constants.m_H))
 
     def get_sound_speed(self):
         """
         Return the sound speed of the gas in cm/s.
         """
-        try:
-            return self.c_s
-        except AttributeError:
-            self.calculate_sound_speed()
-            return self.c_s
+        return self.get_derived('c_s')
 
+    @derived_field('t_ff', 'density', units=['density_unit'])
     def calculate_freefall_time(self):
         """
         Calculate the freefall time of the gas in s.
         """
-        rho = self.get_density() # NOT number density!
-        denominator = 32 * numpy.pi * constants.GRAVITY* rho
-        self.t_ff = numpy.sqrt(3/denominator)
+        rho = self.density # NOT number density!
+        denominator = 32 * numpy.pi * constants.GRAVITY * rho
+        return numpy.sqrt(3/denominator)
 
     def get_freefall_time(self):
         """
         Return the freefall time of the gas in s.
         """
-        try:
-            return self.t_ff
-        except AttributeError:
-            self.calculate_freefall_time()
-            return self.t_ff
+        return self.get_derived('t_ff')
 
+    @derived_field('jeans_length', 'c_s', 't_ff')
     def calculate_jeans_length(self):
         """
         Calculate Jeans Length for gas in cm.
         """
-        c_s = self.get_sound_speed()
-        t_ff = self.get_freefall_time()
-        self.jeans_length = c_s * t_ff
+        return self.c_s * self.t_ff
 
     def get_jeans_length(self):
         """
         Return Jeans Length for gas in cm.
         """
-        try:
-            return self.jeans_length
-        except AttributeError:
-            self.calculate_jeans_length()
-            return self.jeans_length
+        return self.get_derived('jeans_length')
@@ -3,6 +3,7 @@
 # Jacob Hummel
 
 import sys
+import numpy
 import pandas as pd
 import pyGadget
 #===============================================================================
@@ -19,15 +20,19 @@ def get_cdgm(sim, key):
         print "t_sink={:.1f}".format(t)
     else:
         print "Snapshot {}: z={:.3f}".format(key, z)
+    # Density thresholds are evaluated block by block in constant memory.
+    dlims = numpy.array([10,100,1e4,1e8,1e10])
+    mdens = numpy.zeros(dlims.size)
+    for mass, rho in snap.gas.iter_chunks(['masses', 'density']):
+        ndens = rho * 0.76 / 1.6726e-24 # H number density
+        for i, dlim in enumerate(dlims):
+            mdens[i] += mass[ndens >= dlim].sum(dtype=numpy.float64)
     pos = snap.gas.get_coords(unit='pc', system='spherical', centering='avg')
     r = pos[:,0]
     del pos
-    dens = snap.gas.get_number_density()
     mass = snap.gas.get_masses()
     mdata = [z,t]
-    for dlim in [10,100,1e4,1e8,1e10]:
-        (m,) = pyGadget.analyze.data_slice(dens >= dlim, mass)
-        mdata.append(m.sum())
+    mdata.extend(mdens)
     for rlim in [100, 10, 1, .1, 0.04848, 0.02424, 0.004848]:
         (m,) = pyGadget.analyze.data_slice(r <= rlim, mass)
         mdata.append(m.sum())
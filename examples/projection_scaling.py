@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# projection_scaling.py
+"""
+Benchmark the scaling of the SPH projection engine (visualize.scalar_map)
+with the number of cores, on a synthetic clustered particle distribution.
+
+Usage: python projection_scaling.py [npart (default 1e7)] [pps (default 500)]
+The number of cores available is set by the NUMBA_NUM_THREADS environment
+variable (default: all cores).
+
+No multi-core timings of the projection have been recorded yet: the
+parallel speedup of scalar_map is unmeasured.  Run this script on a
+multi-core node to measure it.  Threads beyond the number of CPUs only
+add overhead, so those rows show no speedup.
+"""
+import sys
+import time
+import multiprocessing
+import numpy
+import gadfly
+
+#===============================================================================
+def synthetic_particles(npart, width=1.0, seed=0):
+    """
+    Gaussian clump of particles with smoothing lengths scaling as
+    density**(-1/3), roughly like a collapsing halo.
+    """
+    rng = numpy.random.RandomState(seed)
+    r = rng.exponential(width/10, npart)
+    phi = rng.uniform(0, 2*numpy.pi, npart)
+    x = r * numpy.cos(phi)
+    y = r * numpy.sin(phi)
+    dens = numpy.exp(-r/(width/10))
+    hsml = 0.05 * width * (npart/1e5)**(-1/3.) * dens**(-1/3.)
+    hsml = numpy.fmin(hsml, width/20)
+    return x, y, dens, hsml
+
+def time_projection(x, y, dens, hsml, width, pps, threads):
+    start = time.time()
+    gadfly.visualize.scalar_map(x, y, dens, hsml, width, pps, (pps, pps),
+                                threads=threads)
+    return time.time() - start
+
+if __name__ == '__main__':
+    npart = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**7
+    pps = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    width = 1.0
+    x, y, dens, hsml = synthetic_particles(npart, width)
+    hsml = numpy.fmax(1.7 * hsml, width/pps/2)
+
+    # Compile the serial and parallel kernels before timing.
+    maxthreads = gadfly.visualize.NUM_THREADS
+    for n in set([1, maxthreads]):
+        time_projection(x[:100], y[:100], dens[:100], hsml[:100], width, pps,
+                        n)
+
+    threads = [1]
+    while threads[-1] * 2 <= maxthreads:
+        threads.append(threads[-1] * 2)
+    if threads[-1] != maxthreads:
+        threads.append(maxthreads)
+
+    print 'Projecting %d particles onto a %dx%d grid.' %(npart, pps, pps)
+    ncpus = multiprocessing.cpu_count()
+    if maxthreads > ncpus:
+        print 'Warning: %d threads on %d CPUs; rows beyond %d threads' \
+            ' measure overhead, not scaling.' %(maxthreads, ncpus, ncpus)
+    print '%8s %10s %8s %10s' %('threads', 'time [s]', 'speedup', 'efficiency')
+    for n in threads:
+        t = time_projection(x, y, dens, hsml, width, pps, n)
+        if n == 1:
+            t1 = t
+        print '%8d %10.2f %8.2f %10.2f' %(n, t, t1/t, t1/t/n)
@@ -54,61 +54,47 @@ def radial_properties(sim, snap, **kwargs):
     halo_properties['snapshot'] = snap
     return halo_properties
 
-#@autojit
 def analyze_halo(redshift, r, gasr, mass, gmass, temp, dens, vel,
                  r_start, r_multiplier, n_min, verbose):
-    k_B = 1.3806e-16 # erg/K
-    m_H = 1.6726e-24 # g
     GRAVITY = 6.6726e-8 # dyne * cm**2 / g**2
-    halo_properties = []
-    n = 0
-    old_n = 0
-    old_r = 0
-    density = 0
-    energy = 0
     # background density:: Omega_m * rho_crit(z)
     background_density = .27 * 9.31e-30 * (1+redshift)**3 
-    rmax = r_start
-    while (density > 178 * background_density or n < 100):
-        inR = numpy.where(r <= rmax)[0]
-        gasinR = numpy.where(gasr <= rmax)[0]
-        n = inR.size
-        if n > old_n + n_min:
-            inShell = numpy.where((r > old_r) & (r <= rmax))[0]
-            gasinShell = numpy.where((gasr > old_r) & (gasr <= rmax))[0]
-            Mtot = mass[inR].sum()
-            Mshell = mass[inShell].sum()
-            energy += GRAVITY * Mtot * Mshell / rmax
-            gMtot = gmass[gasinR].sum()
-            gMshell = gmass[gasinShell].sum()
-            density = 3 * Mtot / (4*numpy.pi * rmax**3)
-            gdensity = 3 * gMtot / (4*numpy.pi * rmax**3)
-            delta = density/background_density
-            shell_vol = 4/3 * numpy.pi * (rmax**3 - old_r**3)
-            rhoShell = Mshell / shell_vol
-            grhoShell = gMshell / shell_vol
-            dens_avg = dens[gasinShell].mean()
-            tshell = pyg.analyze.reject_outliers(temp[gasinShell]).mean()
-            vr = vel[gasinShell, 0].mean()
-            vtheta = vel[gasinShell,1].mean()
-            vphi = vel[gasinShell,2].mean()
-            vr_sigma = vel[gasinShell, 0].std()
-            vtheta_sigma = vel[gasinShell,1].std()
-            vphi_sigma = vel[gasinShell,2].std()
-            if verbose:
-                rpc = rmax/3.08568e18
-                Msun = Mtot/1.989e33
-                print 'R = %.2e pc' %rpc,
-                print 'Mass enclosed: %.2e' %Msun,
-                print 'Energy: %.3e' %energy,
-                print 'delta: %.3f' %delta
-            halo_properties.append((redshift,rmax,delta,Mshell,gMshell,-energy,
-                                    density,gdensity,rhoShell,grhoShell,dens_avg,
-                                    tshell,vr,vtheta,vphi,
-                                    vr_sigma,vtheta_sigma,vphi_sigma,n))
-            old_n = n
-            old_r = rmax
-        rmax *= r_multiplier
+    # Shells grow geometrically from r_start, each holding more than n_min
+    # particles.
+    nbins = numpy.log(r.max()/r_start) / numpy.log(r_multiplier)
+    edges = r_start * r_multiplier**numpy.arange(int(nbins) + 2)
+    edges = numpy.concatenate(([0.], edges))
+    total = pyg.analyze.radial_profile(r, mass, bins=edges, n_min=n_min)
+    edges = numpy.append(0., total.radius.values)
+    fields = {'dens':dens, 'temp':temp,
+              'vr':vel[:,0], 'vtheta':vel[:,1], 'vphi':vel[:,2]}
+    gas = pyg.analyze.radial_profile(gasr, gmass, fields, bins=edges)
+
+    # Stop at the first shell enclosing at least 100 particles with a mean
+    # density below 178 times the background.
+    n = numpy.searchsorted(numpy.sort(r), total.radius.values, side='right')
+    done = (total.density <= 178 * background_density).values & (n >= 100)
+    nshells = numpy.argmax(done) + 1 if done.any() else len(total)
+    energy = numpy.cumsum(GRAVITY * total.Menc * total.Mshell / total.radius)
+    delta = total.density / background_density
+
+    halo_properties = []
+    for i in range(nshells):
+        if verbose:
+            rpc = total.radius[i]/3.08568e18
+            Msun = total.Menc[i]/1.989e33
+            print 'R = %.2e pc' %rpc,
+            print 'Mass enclosed: %.2e' %Msun,
+            print 'Energy: %.3e' %energy[i],
+            print 'delta: %.3f' %delta[i]
+        halo_properties.append((redshift, total.radius[i], delta[i],
+                                total.Mshell[i], gas.Mshell[i], -energy[i],
+                                total.density[i], gas.density[i],
+                                total.rho_shell[i], gas.rho_shell[i],
+                                gas.dens[i], gas.temp[i],
+                                gas.vr[i], gas.vtheta[i], gas.vphi[i],
+                                gas.vr_sigma[i], gas.vtheta_sigma[i],
+                                gas.vphi_sigma[i], n[i]))
     return halo_properties
 
 def chunks(l, n):
@@ -2,7 +2,10 @@
 This package contains tools for reading and analyzing hdf5 snapshot files
 from a modified version of the SPH code Gadget2.
 """
+__version__ = '0.1'
+
 import units
+import constants
 import coordinates
 
 import hdf5
@@ -25,13 +25,28 @@ def find_center(pos_vel, density=None, **kwargs):
                     print ('Center averaged over all particles with density '\
                                'greater than %.2e particles/cc' %dens_limit)
                 #Center on highest density clump, rejecting outliers:
-                center = reject_outliers(pos_vel).mean()
+                # Average in double precision, also for float32 data.
+                hidens = pos_vel.iloc[hidens].astype(numpy.float64)
+                center = reject_outliers(hidens).mean()
                 print 'Density averaged box center:',
             elif centering == 'max':
-                center = pos_vel.iloc[density.argmax()]
+                center = pos_vel.iloc[numpy.asarray(density).argmax()]
                 print 'Density maximum box center:',
         else:
             raise KeyError("'avg' and 'max' centering require gas density")
+    elif centering == 'shrink':
+        pos = pos_vel[['x', 'y', 'z']].values
+        try:
+            vel = pos_vel[['u', 'v', 'w']].values
+        except KeyError:
+            vel = None
+        center, vcenter = shrinking_sphere(pos, vel, **kwargs)
+        if vel is None:
+            center = pandas.Series(center, index=['x', 'y', 'z'])
+        else:
+            center = pandas.Series(numpy.concatenate((center, vcenter)),
+                                   index=['x', 'y', 'z', 'u', 'v', 'w'])
+        print 'Shrinking sphere center:',
     elif centering == 'box':
         center = (pos_vel.max() + pos_vel.min())/2
         try:
@@ -40,10 +55,195 @@ def find_center(pos_vel, density=None, **kwargs):
             pass
         print 'Simple box center:',
     else:
-        raise KeyError("Centering options are 'avg', 'max', and 'box'")
+        raise KeyError("Centering options are 'avg', 'max', 'shrink' "\
+                       "and 'box'")
     print '%.3e %.3e %.3e' %(center.x, center.y, center.z)
     return center
 
+def _neighbors(pos, center, radius, tree=None):
+    """
+    Row numbers of positions within 'radius' of 'center', from a KD-tree
+    over 'pos' if one is given, or else by cutting one axis at a time.
+    """
+    if tree is not None:
+        rows = tree.query_ball_point(center, radius)
+        return numpy.sort(numpy.asarray(rows, dtype=numpy.intp))
+    rows = numpy.flatnonzero(numpy.abs(pos[:,0] - center[0]) <= radius)
+    for i in [1, 2]:
+        near = numpy.abs(pos[rows,i] - center[i]) <= radius
+        rows = rows[near]
+    r2 = ((pos[rows] - center)**2).sum(axis=1)
+    return rows[r2 <= radius**2]
+
+def _shrink(pos, weights, center, radius, factor, nmin, resolution=0):
+    """
+    Shrink a sphere by 'factor' around its center of mass until fewer
+    than 'nmin' particles would remain inside, or the radius reaches the
+    'resolution' of the positions.
+    Returns the final center and radius, and the rows inside.
+    """
+    rows = numpy.arange(pos.shape[0])
+    while True:
+        r2 = ((pos - center)**2).sum(axis=1)
+        inside = r2 <= (factor*radius)**2
+        if numpy.count_nonzero(inside) < nmin or factor*radius <= resolution:
+            return center, radius, rows
+        pos = pos[inside]
+        weights = weights[inside]
+        rows = rows[inside]
+        radius *= factor
+        center = numpy.dot(weights, pos) / weights.sum()
+
+def shrinking_sphere(pos, vel=None, mass=None, **kwargs):
+    """
+    Find the center of the densest clump with the shrinking sphere method
+    (Power et al. 2003): repeatedly move a sphere to the center of mass of
+    the particles inside it and shrink it, until it holds only a few
+    particles.  The sphere is first shrunk on a subsample of the particles,
+    then refined on the full data around the subsample's center.
+    Returns the center and the bulk (mass-weighted mean) velocity of the
+    particles in the final sphere (None if 'vel' is not given).
+
+    pos, vel: (N,3) position and velocity arrays.
+    mass: particle masses (default: equal masses).
+    centering_npart: stop when fewer particles would remain (default 100).
+    shrink_factor: radius shrink per iteration (default 0.8).
+    subsample: number of particles to use in the first pass (default 1e5).
+    tree: KD-tree over 'pos' (e.g. PartType.tree), used to find the
+          neighborhood of the subsample's center.
+    """
+    nmin = kwargs.pop('centering_npart', 100)
+    factor = kwargs.pop('shrink_factor', 0.8)
+    nsub = int(kwargs.pop('subsample', 10**5))
+    tree = kwargs.pop('tree', None)
+    pos = numpy.asarray(pos)
+    npart = pos.shape[0]
+    if mass is None:
+        mass = numpy.ones(npart)
+    mass = numpy.asarray(mass)
+
+    stride = max(npart // nsub, 1)
+    sub = pos[::stride].astype(numpy.float64)
+    # Particles closer than this may have identical stored positions.
+    resolution = numpy.finfo(pos.dtype).eps * numpy.abs(sub).max()
+    center = numpy.average(sub, axis=0, weights=mass[::stride])
+    radius = numpy.sqrt(((sub - center)**2).sum(axis=1).max())
+    center, radius, rows = _shrink(sub, mass[::stride], center, radius,
+                                   factor, nmin, resolution)
+    rows = rows * stride
+    if stride > 1:
+        # The subsample's final sphere holds ~nmin*stride particles of the
+        # full data; refine on those (and a margin around them).
+        radius *= 2
+        rows = _neighbors(pos, center, radius, tree)
+        local = pos[rows].astype(numpy.float64)
+        center, radius, inside = _shrink(local, mass[rows], center, radius,
+                                         factor, nmin, resolution)
+        rows = rows[inside]
+    vcenter = None
+    if vel is not None:
+        vcenter = numpy.average(numpy.asarray(vel)[rows], axis=0,
+                                weights=mass[rows])
+    return center, vcenter
+
+def _shell_starts(r, edges):
+    """
+    Index in r (sorted) of the first particle of each shell (lo, hi],
+    the first shell also including r == edges[0].
+    """
+    start = numpy.searchsorted(r, edges, side='right')
+    start[0] = numpy.searchsorted(r, edges[0], side='left')
+    return start
+
+def _adaptive_edges(r, edges, n_min):
+    """
+    Merge consecutive bins (r sorted) until each holds more than n_min
+    particles.  Leftover particles beyond the last full bin are dropped.
+    """
+    counts = _shell_starts(r, edges)
+    keep = [0]
+    for i in range(1, edges.size):
+        if counts[i] > counts[keep[-1]] + n_min:
+            keep.append(i)
+    return edges[keep]
+
+def radial_profile(r, mass, fields=None, **kwargs):
+    """
+    Radial profile of particles in spherical shells, computed with one
+    sort of the radii.  Returns a DataFrame with one row per shell:
+      r_inner, radius: inner and outer shell radius.
+      npart: number of particles in the shell.
+      Mshell, Menc: mass in the shell and enclosed within 'radius'.
+      rho_shell: shell density.  density: mean density within 'radius'.
+      <field>, <field>_sigma: mass-weighted mean and dispersion of each
+                              field in the shell.
+    Particles on a shell's outer edge belong to that shell, and those on
+    the inner edge of the first shell to the first shell.
+
+    r: particle radii.
+    mass: particle masses (weights).
+    fields: dict (or DataFrame) of per-particle arrays to average.
+    bins: number of bins (default 50) or an array of bin edges.
+    log (default True): log-spaced bins when 'bins' is a number.
+    rmin, rmax: range for numbered bins (default: the data range).
+    n_min: if set, merge bins until each has more than n_min particles.
+    """
+    bins = kwargs.pop('bins', 50)
+    log = kwargs.pop('log', True)
+    n_min = kwargs.pop('n_min', None)
+    r = numpy.asarray(r, dtype=numpy.float64)
+    mass = numpy.asarray(mass, dtype=numpy.float64)
+    order = numpy.argsort(r)
+    r = r[order]
+    mass = mass[order]
+    if numpy.isscalar(bins):
+        rmax = kwargs.pop('rmax', r[-1])
+        if log:
+            rmin = kwargs.pop('rmin', r[r > 0][0])
+            edges = numpy.logspace(numpy.log10(rmin), numpy.log10(rmax),
+                                   bins+1)
+        else:
+            rmin = kwargs.pop('rmin', 0.)
+            edges = numpy.linspace(rmin, rmax, bins+1)
+        # Rounding may move the end points; pin them so that the particles
+        # at rmin and rmax are inside.
+        edges[0] = rmin
+        edges[-1] = rmax
+    else:
+        edges = numpy.asarray(bins, dtype=numpy.float64)
+    if n_min:
+        edges = _adaptive_edges(r, edges, n_min)
+
+    # Particle i lies in shell k if start[k] <= i < start[k+1].
+    start = _shell_starts(r, edges)
+    npart = numpy.diff(start)
+    cumulative = numpy.concatenate(([0.], numpy.cumsum(mass)))
+    Menc = cumulative[start[1:]]
+    Mshell = numpy.diff(cumulative[start])
+    volume = 4./3 * numpy.pi * edges**3
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        profile = pandas.DataFrame({'r_inner':edges[:-1], 'radius':edges[1:],
+                                    'npart':npart, 'Mshell':Mshell,
+                                    'Menc':Menc,
+                                    'rho_shell':Mshell / numpy.diff(volume),
+                                    'density':Menc / volume[1:]},
+                                   columns=['r_inner', 'radius', 'npart',
+                                            'Mshell', 'Menc', 'rho_shell',
+                                            'density'])
+        if fields is not None:
+            inside = slice(start[0], start[-1])
+            shell = numpy.repeat(numpy.arange(npart.size), npart)
+            m = mass[inside]
+            for name in fields.keys():
+                values = numpy.asarray(fields[name],
+                                       dtype=numpy.float64)[order][inside]
+                mean = numpy.bincount(shell, m*values, npart.size) / Mshell
+                dev2 = m * (values - mean[shell])**2
+                var = numpy.bincount(shell, dev2, npart.size) / Mshell
+                profile[name] = mean
+                profile[name+'_sigma'] = numpy.sqrt(var)
+    return profile
+
 def center_box(pos_vel, center=None, vcenter=None, **kwargs):
     density = kwargs.pop('density', None)
     centering = kwargs.get('centering', None)
@@ -72,7 +272,7 @@ def angular_momentum(xyz, uvw, mass):
 def total_angular_momentum(xyz, uvw, mass, L=None):
     if L is None:
         L = angular_momentum(xyz, uvw, mass)
-    return L.sum(axis=0)
+    return L.sum(axis=0, dtype=numpy.float64)
 
 def moment_of_inertia(xyz, uvw, mass, L=None):
     if L is None:
@@ -82,7 +282,7 @@ def moment_of_inertia(xyz, uvw, mass, L=None):
     unitL = L / numpy.linalg.norm(L)
     rxL = numpy.cross(xyz, unitL)
     rxL2 = numpy.einsum('ij,ij->i',rxL,rxL)
-    I = (mass[:, numpy.newaxis] * rxL2).sum()
+    I = (mass[:, numpy.newaxis] * rxL2).sum(dtype=numpy.float64)
     return I
 
 def angular_velocity(xyz, uvw, mass, L=None, I=None):
@@ -0,0 +1,12 @@
+"""
+Benchmarks for gadfly.  Synthetic Gadget2 HDF5 snapshots are written by
+bench.snapgen, and the main analysis paths are timed by bench.timing.
+
+Run from the command line with:
+    python -m gadfly.bench [--ngas N] [--ndm N] [--output results.json]
+"""
+import snapgen
+import timing
+
+from snapgen import write_snapshot
+from timing import run_benchmarks
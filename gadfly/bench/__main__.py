@@ -0,0 +1,39 @@
+# __main__.py
+# Jacob Hummel
+"""
+Run the gadfly benchmarks: python -m gadfly.bench --help
+"""
+import argparse
+import json
+
+from gadfly.bench import run_benchmarks, timing
+
+parser = argparse.ArgumentParser(description='Time gadfly on a synthetic '
+                                 'Gadget2 HDF5 snapshot.')
+parser.add_argument('--ngas', type=float, default=1e5,
+                    help='number of gas particles (default 1e5)')
+parser.add_argument('--ndm', type=float, default=1e5,
+                    help='number of dark matter particles (default 1e5)')
+parser.add_argument('--nfiles', type=int, default=1,
+                    help='number of files per snapshot (default 1)')
+parser.add_argument('--repeat', type=int, default=3,
+                    help='timed runs per benchmark (default 3)')
+parser.add_argument('--pps', type=int, default=500,
+                    help='projection pixels per side (default 500)')
+parser.add_argument('--dtype', default=None,
+                    help="precision to load particle fields in, "
+                    "e.g. 'float32' (default: as stored)")
+parser.add_argument('--path', default=None,
+                    help='directory for the synthetic snapshot '
+                    '(default: temporary)')
+parser.add_argument('--output', '-o', default=None,
+                    help='write the JSON results to this file')
+args = parser.parse_args()
+
+results = run_benchmarks(args.path, int(args.ngas), int(args.ndm),
+                         nfiles=args.nfiles, repeat=args.repeat,
+                         pps=args.pps, dtype=args.dtype,
+                         output=args.output)
+timing.summary(results)
+if args.output is None:
+    print json.dumps(results, indent=2)
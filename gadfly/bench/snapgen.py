@@ -0,0 +1,131 @@
+# snapgen.py
+# Jacob Hummel
+"""
+This module writes synthetic snapshots in the Gadget2 HDF5 format, for
+benchmarking.  Particles are placed in a clustered (isothermal, rho ~ r^-2)
+halo at the center of the box on top of a uniform background.  Particles
+outside the halo are given larger masses, as in a zoom simulation.
+"""
+import numpy
+import h5py
+
+#===============================================================================
+def _clustered_positions(rng, npart, boxsize, r_halo, f_halo):
+    """
+    Positions for 'npart' particles, a fraction 'f_halo' of which follow
+    an isothermal profile of radius 'r_halo' around the box center.
+    """
+    nhalo = int(f_halo * npart)
+    # For rho ~ r^-2 the enclosed mass grows linearly with radius.
+    r = rng.uniform(0, r_halo, nhalo)
+    mu = rng.uniform(-1, 1, nhalo)
+    phi = rng.uniform(0, 2*numpy.pi, nhalo)
+    s = numpy.sqrt(1 - mu**2)
+    halo = numpy.column_stack((r*s*numpy.cos(phi), r*s*numpy.sin(phi), r*mu))
+    halo += boxsize/2
+    background = rng.uniform(0, boxsize, (npart - nhalo, 3))
+    pos = numpy.concatenate((halo, background))
+    return pos[rng.permutation(npart)]
+
+def _particle_data(rng, npart, boxsize, r_halo, f_halo, mass, sph):
+    pos = _clustered_positions(rng, npart, boxsize, r_halo, f_halo)
+    r = numpy.sqrt(((pos - boxsize/2)**2).sum(axis=1))
+    # Low resolution (8x more massive) particles outside the zoom region.
+    masses = numpy.where(r < 2*r_halo, mass, 8*mass)
+    # Rotation about the z-axis inside the halo plus random motions.
+    vel = rng.normal(0, 10., (npart, 3))
+    vrot = 20. * numpy.clip(r_halo/numpy.fmax(r, 1e-10), 0, 1)
+    inhalo = r < r_halo
+    dx = pos[:,0] - boxsize/2
+    dy = pos[:,1] - boxsize/2
+    rcyl = numpy.fmax(numpy.sqrt(dx**2 + dy**2), 1e-10)
+    vel[inhalo,0] -= (vrot * dy / rcyl)[inhalo]
+    vel[inhalo,1] += (vrot * dx / rcyl)[inhalo]
+    data = {'Coordinates':pos, 'Velocities':vel, 'Masses':masses}
+    if sph:
+        m_halo = f_halo * npart * mass
+        rho_bg = (1 - f_halo) * npart * mass / boxsize**3
+        rho = rho_bg + numpy.where(inhalo, m_halo / (4*numpy.pi * r_halo
+                                   * numpy.fmax(r, r_halo/1e3)**2), 0)
+        data['Density'] = rho
+        data['SmoothingLength'] = (3*32*masses / (4*numpy.pi*rho))**(1/3.)
+        data['InternalEnergy'] = rng.uniform(2., 100., npart)
+        data['sink_value'] = numpy.zeros(npart)
+    return data
+
+def write_snapshot(filename, ngas=10**5, ndm=10**5, **kwargs):
+    """
+    Write a synthetic Gadget2 HDF5 snapshot with 'ngas' SPH (PartType0) and
+    'ndm' N-body (PartType1) particles, in default Gadget code units
+    (comoving kpc/h, 1e10 Msun/h, km/s).
+
+    boxsize: side of the (comoving) box (default 1000).
+    redshift: snapshot redshift (default 20).
+    r_halo: radius of the central halo (default boxsize/50).
+    f_halo: fraction of particles in the halo (default 0.5).
+    nfiles: if > 1, split the snapshot into files filename.K.hdf5.
+    double: write double precision datasets (default False).
+    seed: random seed.
+    Returns the list of files written.
+    """
+    boxsize = kwargs.pop('boxsize', 1000.)
+    redshift = kwargs.pop('redshift', 20.)
+    r_halo = kwargs.pop('r_halo', boxsize/50)
+    f_halo = kwargs.pop('f_halo', 0.5)
+    nfiles = kwargs.pop('nfiles', 1)
+    double = kwargs.pop('double', False)
+    rng = numpy.random.RandomState(kwargs.pop('seed', 0))
+    hubble = 0.7
+    dtype = numpy.float64 if double else numpy.float32
+
+    data = {}
+    if ngas > 0:
+        data[0] = _particle_data(rng, ngas, boxsize, r_halo, f_halo,
+                                 1e-5, sph=True)
+        data[0]['ParticleIDs'] = numpy.arange(1, ngas+1, dtype=numpy.uint64)
+    if ndm > 0:
+        data[1] = _particle_data(rng, ndm, boxsize, r_halo, f_halo,
+                                 6e-5, sph=False)
+        data[1]['ParticleIDs'] = numpy.arange(ngas+1, ngas+ndm+1,
+                                              dtype=numpy.uint64)
+    npart = numpy.zeros(6, dtype=numpy.uint64)
+    npart[0] = ngas
+    npart[1] = ndm
+
+    if nfiles > 1:
+        base = filename.replace('.hdf5', '')
+        filenames = ['%s.%d.hdf5' %(base, i) for i in range(nfiles)]
+    else:
+        filenames = [filename]
+    for i, fname in enumerate(filenames):
+        with h5py.File(fname, 'w') as f:
+            thisfile = numpy.zeros(6, dtype=numpy.int32)
+            for ptype, fields in data.items():
+                lo = int(npart[ptype]) * i // nfiles
+                hi = int(npart[ptype]) * (i+1) // nfiles
+                thisfile[ptype] = hi - lo
+                if hi == lo:
+                    continue
+                group = f.create_group('PartType%d' %ptype)
+                for key, values in fields.items():
+                    if key != 'ParticleIDs':
+                        values = values.astype(dtype)
+                    group.create_dataset(key, data=values[lo:hi])
+            header = f.create_group('Header')
+            header.attrs['NumPart_ThisFile'] = thisfile
+            header.attrs['NumPart_Total'] = (npart % 2**32).astype(numpy.uint32)
+            header.attrs['NumPart_Total_HighWord'] = \
+                (npart >> 32).astype(numpy.uint32)
+            header.attrs['MassTable'] = numpy.zeros(6)
+            header.attrs['Time'] = 1. / (1 + redshift)
+            header.attrs['Redshift'] = float(redshift)
+            header.attrs['BoxSize'] = boxsize
+            header.attrs['NumFilesPerSnapshot'] = nfiles
+            header.attrs['Omega0'] = 0.3
+            header.attrs['OmegaLambda'] = 0.7
+            header.attrs['HubbleParam'] = hubble
+            header.attrs['Flag_DoublePrecision'] = int(double)
+            for flag in ['Flag_Sfr', 'Flag_Cooling', 'Flag_StellarAge',
+                         'Flag_Metals', 'Flag_Feedback']:
+                header.attrs[flag] = 0
+    return filenames
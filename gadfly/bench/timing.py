@@ -0,0 +1,206 @@
+# timing.py
+# Jacob Hummel
+"""
+This module times the main gadfly analysis paths on a synthetic snapshot
+and reports the results as JSON, so performance can be tracked across
+versions.
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import shutil
+import platform
+import tempfile
+import contextlib
+from collections import OrderedDict
+
+import numpy
+import pandas
+import h5py
+
+import gadfly
+from gadfly import analyze, visualize
+from snapgen import write_snapshot
+
+#===============================================================================
+@contextlib.contextmanager
+def _quiet(enabled=True):
+    """
+    Suppress the progress messages printed by gadfly while timing.
+    """
+    if not enabled:
+        yield
+        return
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+def time_call(func, setup=None, repeat=3, quiet=True):
+    """
+    Time func(*setup()) 'repeat' times; setup (if given) is called
+    before each run and is not timed.
+    Returns a dictionary of the best and mean times, and all times.
+    """
+    times = []
+    for i in range(repeat):
+        with _quiet(quiet):
+            args = setup() if setup else ()
+            start = timeit.default_timer()
+            func(*args)
+            times.append(timeit.default_timer() - start)
+    return OrderedDict([('best', min(times)),
+                        ('mean', sum(times)/len(times)),
+                        ('times', times)])
+
+def environment():
+    """
+    Versions of gadfly, python and the main dependencies.
+    """
+    env = OrderedDict([('gadfly', gadfly.__version__),
+                       ('python', platform.python_version()),
+                       ('numpy', numpy.__version__),
+                       ('pandas', pandas.__version__),
+                       ('h5py', h5py.__version__)])
+    try:
+        import numba
+        env['numba'] = numba.__version__
+    except ImportError:
+        env['numba'] = None
+    env['platform'] = platform.platform()
+    env['threads'] = visualize.NUM_THREADS
+    return env
+
+#===============================================================================
+def run_benchmarks(path=None, ngas=10**5, ndm=10**5, **kwargs):
+    """
+    Write a synthetic snapshot and time loading, refinement, box
+    orientation, centering and projection (visualize.project) on it.
+
+    path: directory for the synthetic snapshot (default: a temporary
+          directory, removed afterwards).
+    ngas, ndm: number of gas and dark matter particles.
+    nfiles: number of files to split the snapshot into (default 1).
+    repeat: number of timed runs of each benchmark (default 3).
+    pps: projection grid size in pixels per side (default 500).
+    output: if set, also write the JSON results to this file.
+    dtype: precision to load particle fields in (Simulation dtype).
+    quiet (default True): suppress gadfly's messages while timing.
+    Remaining kwargs are passed to bench.write_snapshot.
+    Returns the results as a dictionary.
+    """
+    nfiles = kwargs.pop('nfiles', 1)
+    repeat = kwargs.pop('repeat', 3)
+    pps = kwargs.pop('pps', 500)
+    output = kwargs.pop('output', None)
+    quiet = kwargs.pop('quiet', True)
+    dtype = kwargs.pop('dtype', None)
+    tmpdir = path is None
+    if tmpdir:
+        path = tempfile.mkdtemp(prefix='gadfly_bench_')
+    timings = OrderedDict()
+    opened = []
+    try:
+        write_snapshot(os.path.join(path, 'snapshot_000.hdf5'),
+                       ngas, ndm, nfiles=nfiles, **kwargs)
+        sim = gadfly.Simulation(path, dtype=dtype)
+
+        def open_snapshot(**load_args):
+            snap = sim.load_snapshot(0, **load_args)
+            opened.append(snap)
+            return snap
+
+        def load_snapshot():
+            open_snapshot().close()
+        timings['load_snapshot'] = time_call(load_snapshot, repeat=repeat,
+                                             quiet=quiet)
+
+        snap = open_snapshot()
+        loaders = [('gas', ['masses', 'coords', 'velocities', 'density',
+                            'internal_energy', 'smoothing_length']),
+                   ('dm', ['masses', 'coords', 'velocities'])]
+        for ptype, fields in loaders:
+            for field in fields:
+                func = getattr(getattr(snap, ptype), 'load_'+field)
+                timings[ptype+'.load_'+field] = time_call(func, repeat=repeat,
+                                                          quiet=quiet)
+
+        for ptype in ['gas', 'dm']:
+            def refine_setup():
+                return (getattr(open_snapshot(), ptype),)
+            timings[ptype+'.refine_dataset'] = time_call(
+                lambda p: p.refine_dataset(), refine_setup, repeat, quiet)
+
+        def orient_setup():
+            gas = open_snapshot().gas
+            gas.load_coords()
+            gas.load_velocities()
+            return (gas,)
+        timings['gas.orient_box'] = time_call(
+            lambda gas: gas.orient_box(centering='box', view='xz'),
+            orient_setup, repeat, quiet)
+
+        with _quiet(quiet):
+            gas = open_snapshot().gas
+            gas.load_data('coordinates', 'velocities', 'density',
+                          'smoothing_length')
+            pos_vel = gas[['x', 'y', 'z', 'u', 'v', 'w']]
+            dens = gas.density
+        for centering in ['max', 'avg', 'shrink']:
+            timings['find_center.'+centering] = time_call(
+                lambda: analyze.find_center(pos_vel, dens,
+                                            centering=centering,
+                                            dens_limit=dens.max()),
+                repeat=repeat, quiet=quiet)
+
+        with _quiet(quiet):
+            centered = analyze.center_box(pos_vel.copy(), centering='box')
+            x = centered['x'].values
+            width = 0.1 * (x.max() - x.min())
+        scale = '%.6f%s' %(width, sim.units.length_unit)
+        def projection_setup():
+            snap = open_snapshot()
+            snap.gas.get_number_density()
+            snap.gas.get_coords()
+            snap.gas.get_smoothing_length()
+            return (snap,)
+        def projection(snap):
+            visualize.project(snap, scale, 'xy', pps=pps, centering='box')
+        # Compile the projection kernel before timing it.
+        with _quiet(quiet):
+            projection(*projection_setup())
+        timings['projection'] = time_call(projection, projection_setup,
+                                          repeat, quiet)
+    finally:
+        for snap in opened:
+            with _quiet():
+                snap.close()
+        if tmpdir:
+            shutil.rmtree(path)
+
+    results = OrderedDict([('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+                           ('environment', environment()),
+                           ('ngas', ngas), ('ndm', ndm), ('nfiles', nfiles),
+                           ('repeat', repeat), ('pps', pps),
+                           ('dtype', dtype),
+                           ('timings', timings)])
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+def summary(results):
+    """
+    Print a table of the best and mean time for each benchmark.
+    """
+    print 'gadfly %s: %d gas, %d dm particles in %d file(s)' \
+        %(results['environment']['gadfly'], results['ngas'], results['ndm'],
+          results['nfiles'])
+    print '%-28s %10s %10s' %('benchmark', 'best [s]', 'mean [s]')
+    for name, t in results['timings'].items():
+        print '%-28s %10.4f %10.4f' %(name, t['best'], t['mean'])
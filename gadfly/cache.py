@@ -0,0 +1,109 @@
+# cache.py
+# Jacob Hummel
+"""
+On-disk cache of particle fields, stored as .npy files that are memory
+mapped when read back.
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy
+
+class FieldCache(object):
+    """
+    Cache of the fields of one particle type of one snapshot, in
+    path/<snapshot>/PartType<N>/<stamp>/, where <stamp> is a digest of
+    the modification time and size of the snapshot file(s).  Entries are
+    keyed by a caller-supplied key (units, particle selection, ...), so
+    they are never reused for a rewritten snapshot or a different unit
+    system.  Entries of earlier versions of the snapshot are deleted when
+    new ones are written.
+    """
+    def __init__(self, path, filenames, ptype):
+        base = os.path.basename(filenames[0]).replace('.hdf5', '')
+        self.root = os.path.join(path, base.split('.')[0],
+                                 'PartType%d' %ptype)
+        self.stamp = []
+        for fname in filenames:
+            stat = os.stat(fname)
+            self.stamp.append((os.path.basename(fname), stat.st_mtime,
+                               stat.st_size))
+        digest = hashlib.md5(repr(self.stamp)).hexdigest()[:16]
+        self.path = os.path.join(self.root, digest)
+        self._pruned = False
+
+    def _filename(self, field, key):
+        digest = hashlib.md5(repr(key)).hexdigest()[:16]
+        return os.path.join(self.path, '%s-%s.npy'
+                            %(field.replace(' ', '_'), digest))
+
+    def prune(self):
+        """
+        Delete the entries written for other versions of the snapshot
+        file(s).
+        """
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return
+        current = os.path.basename(self.path)
+        for name in names:
+            if name != current:
+                stale = os.path.join(self.root, name)
+                if os.path.isdir(stale):
+                    shutil.rmtree(stale, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(stale)
+                    except OSError:
+                        pass
+
+    def load(self, field, key):
+        """
+        Return the cached array (memory mapped, copy-on-write) for 'field'
+        and 'key', or None if there is none.
+        """
+        fname = self._filename(field, key)
+        if not os.path.exists(fname):
+            return None
+        try:
+            return numpy.load(fname, mmap_mode='c')
+        except (IOError, ValueError):
+            return None
+
+    def save(self, field, key, data):
+        """
+        Store 'data' for 'field' and 'key'.  Failure to write is not an
+        error; the field is simply not cached.  Each writer uses its own
+        temporary file, renamed into place, so concurrent writers (e.g.
+        Simulation.multitask workers) never see a partial file.
+        """
+        fname = self._filename(field, key)
+        tmpname = None
+        if not self._pruned:
+            self.prune()
+            self._pruned = True
+        try:
+            if not os.path.isdir(self.path):
+                try:
+                    os.makedirs(self.path)
+                except OSError:
+                    # Created meanwhile by another writer.
+                    if not os.path.isdir(self.path):
+                        raise
+            fd, tmpname = tempfile.mkstemp(dir=self.path, suffix='.tmp',
+                                           prefix=os.path.basename(fname))
+            with os.fdopen(fd, 'wb') as f:
+                numpy.save(f, numpy.asarray(data))
+            os.rename(tmpname, fname)
+        except (IOError, OSError):
+            print 'Warning: could not write field cache', fname
+            if tmpname is not None and os.path.exists(tmpname):
+                os.remove(tmpname)
+
+    def clear(self):
+        """
+        Remove all cached fields of this particle type.
+        """
+        shutil.rmtree(self.root, ignore_errors=True)
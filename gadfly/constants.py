@@ -0,0 +1,9 @@
+# constants.py
+# Jacob Hummel
+"""
+Physical constants in cgs units.
+"""
+k_B = 1.3806e-16 # erg/K
+m_H = 1.6726e-24 # g
+GRAVITY = 6.6726e-8 # dyne * cm**2 / g**2
+X_h = 0.76 # hydrogen mass fraction
@@ -104,11 +104,64 @@ def rotation_matrix(axis, angle):
     rot = np.asarray(rot)
     return rot
 
+# Composed rotation matrices, by view.
+_view_matrices = {}
+
+def view_matrix(view):
+    """
+    Return the single rotation matrix for a view: 'xy', 'xz', 'yz', or a
+    sequence of (axis, angle) rotations applied in order.  Matrices are
+    cached by view (if it is hashable) and must not be modified.
+    """
+    try:
+        return _view_matrices[view]
+    except (KeyError, TypeError):
+        pass
+    if view == 'xy':
+        steps = []
+    elif view == 'xz':
+        steps = [('x', np.pi/2)]
+    elif view == 'yz':
+        steps = [('z', np.pi/2), ('x', np.pi/2)]
+    else:
+        steps = view
+    rot = np.identity(3)
+    for axis, angle in steps:
+        rot = np.dot(rot, rotation_matrix(axis, angle))
+    rot.flags.writeable = False
+    try:
+        _view_matrices[view] = rot
+    except TypeError:
+        pass
+    return rot
+
+def transform(coords, rot, chunk_size=2**16):
+    """
+    Multiply the row vectors of 'coords' by the matrix 'rot', in place.
+    coords: (N,3) array or DataFrame, or an array holding several vectors
+            per row, e.g. stacked positions and velocities (N,6).
+    Contiguous arrays are transformed chunk_size vectors at a time, so
+    only a small temporary is needed.
+    """
+    if not isinstance(coords, np.ndarray):
+        values = np.ascontiguousarray(coords.values)
+        coords[coords.columns] = transform(values, rot, chunk_size)
+        return coords
+    if coords.dtype.kind == 'f':
+        rot = rot.astype(coords.dtype, copy=False)
+    vectors = coords.reshape(-1, 3)
+    if not np.may_share_memory(vectors, coords):
+        coords[...] = np.dot(vectors, rot).reshape(coords.shape)
+        return coords
+    for start in xrange(0, vectors.shape[0], chunk_size):
+        block = vectors[start:start+chunk_size]
+        block[...] = np.dot(block, rot)
+    return coords
+
 def rotate(coords, axis, angle, verbose=False):
     rot = rotation_matrix(axis,angle)
     if verbose:
         print "Rotating about the {}-axis by {:6.3f} radians.".format(axis,angle)
         print "Rotation Matrix:"
         print rot
-    coords[coords.columns] = np.dot(coords,rot)
-    return coords
\ No newline at end of file
+    return transform(coords, rot)
\ No newline at end of file
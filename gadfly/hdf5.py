@@ -3,14 +3,237 @@
 """
 This module contains classes for reading Gadget2 HDF5 snapshot data.
 """
+import os
+import hashlib
+import threading
+from multiprocessing import cpu_count
 import numpy
-from pandas import Series, DataFrame
+import h5py
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+from pandas import DataFrame, Index, RangeIndex
 
 import units
 import coordinates
+from cache import FieldCache
 import analyze
 import visualize
-        
+
+# Number of particles read per block when scanning datasets piecewise.
+CHUNK_SIZE = 2**20
+
+def read_rows(dataset, rows):
+    """
+    Read the given (sorted) rows of an HDF5 dataset.  The dataset is read
+    in hyperslabs of at most CHUNK_SIZE particles; blocks containing no
+    requested rows are skipped.
+    """
+    data = numpy.empty((rows.size,) + dataset.shape[1:], dataset.dtype)
+    if rows.size == 0:
+        return data
+    bounds = numpy.arange(rows[0], rows[-1] + 1 + CHUNK_SIZE, CHUNK_SIZE)
+    edges = numpy.searchsorted(rows, bounds)
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        if hi > lo:
+            first = rows[lo]
+            block = dataset[first:rows[hi-1]+1]
+            data[lo:hi] = block[rows[lo:hi] - first]
+    return data
+
+def memmap_dataset(dataset):
+    """
+    Map an HDF5 dataset stored contiguously and uncompressed in a plain
+    file as a (copy-on-write) numpy.memmap, so that only the pages
+    actually used are read, and are shared through the OS page cache
+    between processes reading the same snapshot.  Returns None for
+    datasets that cannot be mapped (chunked or compressed, not yet
+    allocated, or in a file opened with a non-default driver).  The
+    pieces of a multi-file dataset are mapped one by one (see
+    MultiFileDataset.mapped).
+    """
+    if not isinstance(dataset, h5py.Dataset):
+        return None
+    if dataset.chunks is not None or dataset.dtype.hasobject:
+        return None
+    if dataset.size == 0 or dataset.file.driver not in ('sec2', 'stdio'):
+        return None
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None
+    return numpy.memmap(dataset.file.filename, dtype=dataset.dtype, mode='c',
+                        offset=offset, shape=dataset.shape)
+
+def scale(data, factor, dtype=None):
+    """
+    Multiply 'data' by 'factor' (None for no conversion), and cast
+    floating point data to 'dtype' if given.  Done in place if data is an
+    array of the result type holding its own memory (a buffer just read
+    from file), else into a new array.  A factor too large for 'dtype'
+    keeps the wider type the product needs.
+    """
+    if data.dtype.kind != 'f':
+        dtype = None
+    if factor is None or factor == 1:
+        if dtype is None:
+            return data
+        return data.astype(dtype, copy=False)
+    result = numpy.promote_types(dtype or data.dtype,
+                                 numpy.min_scalar_type(factor))
+    if (data.dtype == result and data.flags.owndata
+        and data.flags.writeable):
+        data *= factor
+        return data
+    return numpy.multiply(data, factor, dtype=result)
+
+class MultiFileDataset(object):
+    """
+    A dataset split across the pieces of a multi-file snapshot, presented
+    as a single dataset.  Supports the subset of the h5py Dataset
+    interface used by PartType: shape, dtype, value and slicing.  Pieces
+    are h5py datasets, or memory maps of them (see mapped).
+    """
+    def __init__(self, pieces, threads=None):
+        self.pieces = pieces
+        lengths = [piece.shape[0] for piece in pieces]
+        self.offsets = numpy.concatenate(([0], numpy.cumsum(lengths)))
+        self.shape = (int(self.offsets[-1]),) + pieces[0].shape[1:]
+        self.dtype = pieces[0].dtype
+        self.threads = threads
+
+    def __len__(self):
+        return self.shape[0]
+
+    def mapped(self):
+        """
+        Return this dataset with every piece that can be memory mapped
+        (see memmap_dataset) replaced by its map.
+        """
+        pieces = []
+        for piece in self.pieces:
+            mapped = memmap_dataset(piece)
+            pieces.append(piece if mapped is None else mapped)
+        return MultiFileDataset(pieces, self.threads)
+
+    @property
+    def value(self):
+        """
+        Read the full dataset, each piece directly into its slice of a
+        preallocated array.  Memory-mapped pieces are copied in parallel
+        threads (numpy releases the GIL for the copy, and the page faults
+        reading the file happen inside it).  Reads through h5py hold its
+        global lock, so pieces that cannot be mapped are in effect read
+        one at a time.
+        """
+        data = numpy.empty(self.shape, self.dtype)
+        errors = []
+        def read_pieces(pieces):
+            try:
+                for i in pieces:
+                    lo, hi = self.offsets[i], self.offsets[i+1]
+                    if hi <= lo:
+                        continue
+                    piece = self.pieces[i]
+                    if isinstance(piece, numpy.ndarray):
+                        data[lo:hi] = piece
+                    else:
+                        piece.read_direct(data, dest_sel=numpy.s_[lo:hi])
+            except Exception as e:
+                errors.append(e)
+        # Plain threads rather than a pool: a pool adds up to 0.1s of
+        # shutdown latency to every read.
+        npieces = len(self.pieces)
+        nthreads = min(self.threads or cpu_count(), npieces)
+        workers = [threading.Thread(target=read_pieces,
+                                    args=(range(t, npieces, nthreads),))
+                   for t in range(nthreads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+        return data
+
+    def __getitem__(self, key):
+        if key is Ellipsis or key == ():
+            return self.value
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError('Multi-file datasets support simple slices only.')
+        start, stop, step = key.indices(self.shape[0])
+        stop = max(start, stop)
+        data = numpy.empty((stop - start,) + self.shape[1:], self.dtype)
+        for i, piece in enumerate(self.pieces):
+            lo = max(start, self.offsets[i])
+            hi = min(stop, self.offsets[i+1])
+            if hi > lo:
+                offset = self.offsets[i]
+                data[lo-start:hi-start] = piece[lo-offset:hi-offset]
+        return data
+
+class MultiFileGroup(object):
+    """
+    A particle group split across the pieces of a multi-file snapshot.
+    """
+    def __init__(self, groups, threads=None):
+        self.groups = groups
+        self.threads = threads
+
+    def keys(self):
+        return list(self.groups[0].keys())
+
+    def __getitem__(self, key):
+        return MultiFileDataset([group[key] for group in self.groups],
+                                self.threads)
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+class MultiFile(object):
+    """
+    The pieces (snapshot_NNN.K.hdf5) of a multi-file snapshot, presented
+    as a single file.  Particle groups are concatenated in piece order.
+    threads: maximum number of pieces read concurrently.
+    """
+    def __init__(self, filenames, threads=None):
+        self.filenames = filenames
+        self.files = [h5py.File(fname, 'r') for fname in filenames]
+        self.threads = threads
+
+    def keys(self):
+        keys = []
+        for f in self.files:
+            keys.extend(key for key in f.keys() if key not in keys)
+        return keys
+
+    def __getitem__(self, key):
+        if key == 'Header':
+            return self.files[0]['Header']
+        header = self.files[0]['Header'].attrs
+        ptype = int(key.replace('PartType', ''))
+        npart = int(header['NumPart_Total'][ptype])
+        if 'NumPart_Total_HighWord' in header:
+            npart += int(header['NumPart_Total_HighWord'][ptype]) << 32
+        # Pieces holding no particles of this type omit the group.
+        groups = [f[key] for f in self.files if key in f]
+        if not groups:
+            raise KeyError(key)
+        group = MultiFileGroup(groups, self.threads)
+        dkey = list(groups[0].keys())[0]
+        found = sum(g[dkey].shape[0] for g in groups)
+        if found != npart:
+            raise IOError('Snapshot pieces hold %d of %d particles in %s.'
+                          %(found, npart, key))
+        return group
+
+    def __nonzero__(self):
+        return all(bool(f) for f in self.files)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
 class Header(object):
     """
     Class for header information from Gadget2 HDF5 snapshots.
@@ -34,10 +257,36 @@ class Header(object):
         """
         return vars(self)[key]
 
+def derived_field(name, *inputs, **kwargs):
+    """
+    Decorator registering a PartType method as the calculation of the
+    derived column 'name' from the fields 'inputs' (column names, or
+    vector fields such as 'coordinates').  The method returns the values,
+    aligned with the frame.
+    units: Units attributes the result depends on beyond its inputs,
+           e.g. ['length_unit'].
+    """
+    def register(method):
+        method._derived = (name, tuple(inputs), tuple(kwargs.get('units', ())))
+        return method
+    return register
+
 class PartType(DataFrame):
     """
     Class for generic particle info.
+
+    Columns are loaded lazily: requesting a column (or attribute) that has
+    not been loaded yet, e.g. snap.gas['density'] or snap.gas.density,
+    reads and unit-converts it from the snapshot file and caches it.
+
+    Derived columns are declared with the derived_field decorator.  They
+    are calculated once when requested and dropped whenever one of their
+    inputs is reassigned, or recalculated if their units have changed.
     """
+    # Columns filled by loading vector-valued datasets.
+    _vector_columns = {'coordinates':['x', 'y', 'z'],
+                       'velocities':['u', 'v', 'w']}
+
     def __init__(self, file_id, ptype, sim, **kwargs):
         group = file_id['PartType'+str(ptype)]
         for item in group.items():
@@ -47,18 +296,87 @@ class PartType(DataFrame):
             else:
                 key = '_'+item[0].replace(' ', '_')
                 vars(self)[key] = item[1]
-        super(PartType, self).__init__(index=self._particleIDs.value)
-        self._drop_ids = None
-        self._header = Header(file_id)
-        self.units = sim.units
+        vars(self)['_header'] = Header(file_id)
+        vars(self)['units'] = sim.units
+        vars(self)['_memmap'] = getattr(sim, 'memmap', True)
+        dtype = getattr(sim, 'dtype', None)
+        vars(self)['_dtype'] = numpy.dtype(dtype) if dtype else None
+        # Index rows by their position in the snapshot file so that no data
+        # is read until a column is requested.  Particle IDs are available
+        # as a column.  If a region is given, only rows inside it are kept.
+        region = kwargs.get('region', None)
+        if region is None:
+            vars(self)['_rows'] = None
+            index = RangeIndex(self._particleIDs.shape[0])
+        else:
+            shape = kwargs.get('region_shape', 'sphere')
+            vars(self)['_rows'] = self._select_region(region[0], region[1],
+                                                      shape)
+            index = Index(self._rows)
+        super(PartType, self).__init__(index=index)
+        # Boolean mask over the rows read from file (all rows, or those in
+        # the region) marking particles kept by refine_dataset.
+        vars(self)['_mask'] = None
+        vars(self)['_loading'] = set()
+        # Unit settings each calculated derived column was made with.
+        vars(self)['_derived_units'] = {}
+        # Columns holding data as read from file, or derived only from
+        # such columns; only these are stored in the field cache.
+        vars(self)['_pristine'] = set()
+        vars(self)['_field_cache'] = None
+        if getattr(sim, 'field_cache', False):
+            filenames = getattr(file_id, 'filenames', [file_id.filename])
+            vars(self)['_field_cache'] = FieldCache(
+                os.path.join(sim.savepath, 'field_cache'), filenames, ptype)
         self.__init_load_dict__()
 
+    def __getitem__(self, key):
+        if self._is_derived(key):
+            return self.get_derived(key)
+        if isinstance(key, list):
+            for k in key:
+                if self._is_derived(k):
+                    self.get_derived(k)
+        try:
+            return super(PartType, self).__getitem__(key)
+        except KeyError:
+            if not self._load_missing(key):
+                raise
+            return super(PartType, self).__getitem__(key)
+
+    def __getattr__(self, name):
+        if self._is_derived(name):
+            return self.get_derived(name)
+        try:
+            return super(PartType, self).__getattr__(name)
+        except AttributeError:
+            if name.startswith('_') or not self._load_missing(name):
+                raise
+            return super(PartType, self).__getattr__(name)
+
+    def __setitem__(self, key, value):
+        try:
+            columns = set([key] if isinstance(key, basestring) else key)
+        except TypeError:
+            columns = set()
+        # Changing the coordinates invalidates the spatial tree.
+        if '_tree' in vars(self):
+            if columns.intersection(self._vector_columns['coordinates']):
+                del vars(self)['_tree']
+        if 'particleIDs' in columns:
+            vars(self).pop('_id_index', None)
+        if vars(self).get('_derived_units'):
+            self._invalidate_derived(columns)
+        vars(self).get('_pristine', set()).difference_update(columns)
+        super(PartType, self).__setitem__(key, value)
+
     def __getstate__(self):
         result = self.__dict__.copy()
         del result['_coordinates']
         del result['_particleIDs']
         del result['_velocities']
         del result['_masses']
+        result.pop('_tree', None)
         return result
 
     def __setstate__(self, in_dict):
@@ -69,21 +387,536 @@ class PartType(DataFrame):
         self._load_dict = {'particleIDs':self.load_PIDs}
         self.loadable_keys = self._load_dict.keys()
 
+    @classmethod
+    def _derived_fields(cls):
+        """
+        Registry of derived fields of this class and its bases:
+        {name: (method name, inputs, units)}.
+        """
+        if '_derived_registry' not in vars(cls):
+            registry = {}
+            for klass in reversed(cls.__mro__):
+                if not issubclass(klass, PartType):
+                    continue
+                for attr, value in vars(klass).items():
+                    spec = getattr(value, '_derived', None)
+                    if spec is not None:
+                        registry[spec[0]] = (attr,) + spec[1:]
+            cls._derived_registry = registry
+        return cls._derived_registry
+
+    def _is_derived(self, key):
+        """
+        True if 'key' is a derived column to access through get_derived,
+        which recalculates it if its units have changed: one not yet
+        calculated, or calculated by get_derived.  Columns assigned
+        directly are returned as they are.
+        """
+        if (not isinstance(key, basestring) or
+            key not in self._derived_fields() or
+            key in vars(self).get('_loading', ())):
+            return False
+        return (key not in self.columns or
+                key in vars(self).get('_derived_units', {}))
+
+    def _unit_signature(self, units):
+        return tuple(getattr(self.units, unit) for unit in units)
+
+    def get_derived(self, name):
+        """
+        Return derived column 'name', calculating it (and any derived
+        inputs) if it has not been calculated with the current units.
+        """
+        method, inputs, units = self._derived_fields()[name]
+        state = self._derived_units
+        if (name in self.columns and
+            state.get(name) == self._unit_signature(units)):
+            return super(PartType, self).__getitem__(name)
+        cache = vars(self).get('_field_cache')
+        cacheable = (cache is not None and
+                     all(self._is_pristine(field) for field in inputs))
+        cached = None
+        if cacheable:
+            key = (self._field_key(name), self._selection_key())
+            cached = cache.load(name, key)
+            if cached is not None:
+                self[name] = self._as_dtype(cached)
+        if cached is None:
+            for field in inputs:
+                if field in self._derived_fields():
+                    self.get_derived(field)
+                else:
+                    self._load_missing(self._vector_columns.get(field, field))
+            values = self._as_dtype(getattr(self, method)())
+            self[name] = values
+            if cacheable:
+                cache.save(name, key, values)
+        if cacheable:
+            self._pristine.add(name)
+        state[name] = self._unit_signature(units)
+        return super(PartType, self).__getitem__(name)
+
+    def _as_dtype(self, data):
+        """
+        Cast floating point data (array, Series or DataFrame) to the
+        simulation's dtype, if it sets one.
+        """
+        dtype = self._dtype
+        if dtype is None:
+            return data
+        if isinstance(data, DataFrame):
+            columns = [c for c in data.columns if data[c].dtype.kind == 'f'
+                       and data[c].dtype != dtype]
+            if columns:
+                data = data.astype(dict.fromkeys(columns, dtype))
+            return data
+        if getattr(data, 'dtype', None) is not None and data.dtype.kind == 'f':
+            return data.astype(dtype, copy=False)
+        return data
+
+    def _is_pristine(self, field):
+        """
+        True if 'field' is not loaded, or holds data as read from file.  A
+        derived field not yet calculated is pristine if its inputs are.
+        """
+        if field in self._derived_fields() and field not in self.columns:
+            inputs = self._derived_fields()[field][1]
+            return all(self._is_pristine(f) for f in inputs)
+        columns = self._vector_columns.get(field, [field])
+        return all(c not in self.columns or c in self._pristine
+                   for c in columns)
+
+    def _field_key(self, field):
+        """
+        Key for the field cache identifying the units and precision of
+        'field': its unit conversion, or for a derived field, its unit
+        settings and the keys of its inputs, and the simulation dtype.
+        """
+        dtype = str(self._dtype)
+        if field in self._derived_fields():
+            method, inputs, units = self._derived_fields()[field]
+            return (field, self._unit_signature(units),
+                    tuple(self._field_key(f) for f in inputs), dtype)
+        for vector, columns in self._vector_columns.items():
+            if field in columns:
+                field = vector
+        return (field, repr(self._conversion_factor(field)), dtype)
+
+    def _selection_key(self):
+        """
+        Digest of the particles selected by region and refinement, as a
+        key for the field cache.
+        """
+        try:
+            return vars(self)['_selection']
+        except KeyError:
+            md5 = hashlib.md5()
+            for selection in [self._rows, self._mask]:
+                if selection is None:
+                    md5.update('all')
+                else:
+                    md5.update(numpy.ascontiguousarray(selection))
+            vars(self)['_selection'] = md5.hexdigest()
+            return vars(self)['_selection']
+
+    def _invalidate_derived(self, columns):
+        """
+        Drop the calculated derived columns downstream of 'columns'.
+        """
+        changed = set(columns)
+        for vector, vector_columns in self._vector_columns.items():
+            if changed.intersection(vector_columns):
+                changed.add(vector)
+        stale = []
+        registry = self._derived_fields()
+        grew = True
+        while grew:
+            grew = False
+            for name, (method, inputs, units) in registry.items():
+                if name not in changed and changed.intersection(inputs):
+                    changed.add(name)
+                    stale.append(name)
+                    grew = True
+        state = self._derived_units
+        stale = [name for name in stale
+                 if state.pop(name, None) is not None and name in self.columns]
+        if stale:
+            self.drop(stale, axis=1, inplace=True)
+
+    def _load_missing(self, key):
+        """
+        Load column(s) not yet present in the frame.  Returns True if
+        anything was loaded.  Only primary (non-calculated) quantities are
+        loaded automatically.
+        """
+        load_dict = self.__dict__.get('_load_dict', {})
+        calculated = self.__dict__.get('_calculated', [])
+        loading = self.__dict__.get('_loading', set())
+        keys = key if isinstance(key, list) else [key]
+        loaded = False
+        for k in keys:
+            if not isinstance(k, basestring) or k in self.columns:
+                continue
+            field = k
+            for vector, columns in self._vector_columns.items():
+                if k in columns:
+                    field = vector
+            if field in loading:
+                continue
+            if field in self._derived_fields():
+                loading.add(field)
+                try:
+                    self.get_derived(field)
+                finally:
+                    loading.discard(field)
+                loaded = True
+                continue
+            if field in calculated:
+                continue
+            dataset = self.__dict__.get('_'+field.replace(' ', '_'))
+            if (field in load_dict or
+                isinstance(dataset, (h5py.Dataset, MultiFileDataset))):
+                loading.add(field)
+                try:
+                    self.load_quantity(field)
+                finally:
+                    loading.discard(field)
+                loaded = True
+        return loaded
+
+    def _select_region(self, center, radius, shape='sphere'):
+        """
+        Return the (sorted) row numbers of particles inside a region,
+        reading the coordinates dataset one block at a time.
+        center: region center in the current coordinate units.
+        radius: sphere radius, or box half-width (scalar or per-axis).
+        shape: 'sphere' or 'box'.
+        """
+        if shape not in ['sphere', 'box']:
+            raise KeyError("Region shape options are 'sphere' and 'box'")
+        # Convert the region to code units rather than the coordinates.
+        conv = self._conversion_factor('coordinates')
+        if conv is None:
+            conv = 1.
+        center = numpy.asarray(center, dtype=numpy.float64) / conv
+        radius = numpy.asarray(radius, dtype=numpy.float64) / conv
+
+        coords = self._mapped(self._coordinates)
+        rows = []
+        for start in xrange(0, coords.shape[0], CHUNK_SIZE):
+            xyz = coords[start:start+CHUNK_SIZE] - center
+            if shape == 'sphere':
+                inside = numpy.einsum('ij,ij->i', xyz, xyz) <= radius**2
+            else:
+                inside = (numpy.abs(xyz) <= radius).all(axis=1)
+            rows.append(numpy.flatnonzero(inside) + start)
+        rows = numpy.concatenate(rows) if rows else numpy.arange(0)
+        print rows.size, 'particles in region.'
+        return rows
+
+    def _mapped(self, dataset):
+        """
+        Return a memory map of 'dataset' if it can be mapped (see
+        memmap_dataset) and memory mapping is enabled, else the dataset.
+        Multi-file datasets are returned with their pieces mapped.
+        """
+        if self._memmap:
+            if isinstance(dataset, MultiFileDataset):
+                return dataset.mapped()
+            mapped = memmap_dataset(dataset)
+            if mapped is not None:
+                return mapped
+        return dataset
+
+    def _read_dataset(self, dataset):
+        """
+        Read a particle dataset, restricted to the selected particles:
+        rows inside the region (if any) that survive refinement.
+        Mappable datasets are not copied unless rows are selected.
+        """
+        dataset = self._mapped(dataset)
+        if isinstance(dataset, numpy.ndarray):
+            data = dataset if self._rows is None else dataset[self._rows]
+        elif self._rows is None:
+            data = dataset.value
+        else:
+            data = read_rows(dataset, self._rows)
+        if self._mask is not None:
+            data = data[self._mask]
+        return data
+
+    def _read_field(self, field):
+        """
+        Read 'field' for the selected particles, converted to the current
+        units.  The conversion is a single multiplication, done in place
+        on freshly read buffers but never on a memory map of the file.
+        Fields read as stored (no conversion, all particles) are not put
+        in the field cache, as they can be mapped from the snapshot.
+        """
+        factor = self._conversion_factor(field)
+        cache = vars(self).get('_field_cache')
+        if factor is None and self._rows is None and self._mask is None:
+            cache = None
+        if cache is not None:
+            key = (self._field_key(field), self._selection_key())
+            data = cache.load(field, key)
+            if data is not None:
+                return scale(data, None, self._dtype)
+        data = scale(self._read_dataset(self._dataset(field)), factor,
+                     self._dtype)
+        if cache is not None:
+            cache.save(field, key, data)
+        return data
+
+    @property
+    def arrays(self):
+        """
+        Struct-of-arrays view of this particle type (see ParticleArrays).
+        """
+        try:
+            return vars(self)['_arrays']
+        except KeyError:
+            vars(self)['_arrays'] = ParticleArrays(self)
+            return vars(self)['_arrays']
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the loaded columns and arrays, in bytes.
+        """
+        nbytes = self.memory_usage(index=True).sum()
+        if '_arrays' in vars(self):
+            nbytes += self._arrays.nbytes
+        return nbytes
+
+    @property
+    def tree(self):
+        """
+        KD-tree (scipy.spatial.cKDTree) over the particle coordinates, in
+        the current coordinate units.  Built on first use and rebuilt after
+        the coordinates are changed (e.g. by load_coords or orient_box) or
+        particles are dropped by refine_dataset.
+        """
+        try:
+            return vars(self)['_tree']
+        except KeyError:
+            if cKDTree is None:
+                raise ImportError('Spatial queries require scipy.')
+            xyz = self[self._vector_columns['coordinates']].values
+            # Unbalanced trees build much faster and query about as fast.
+            vars(self)['_tree'] = cKDTree(xyz, balanced_tree=False,
+                                          compact_nodes=False)
+            return vars(self)['_tree']
+
+    def query_sphere(self, center, radius):
+        """
+        Return the (sorted) row numbers of particles within 'radius' of
+        'center'.  Rows are positions in the frame, for use with iloc.
+        """
+        rows = self.tree.query_ball_point(center, radius)
+        return numpy.sort(numpy.asarray(rows, dtype=numpy.intp))
+
+    def query_box(self, center, radius):
+        """
+        Return the (sorted) row numbers of particles inside a box.
+        radius: box half-width, scalar or one per axis.
+        """
+        halfwidth = numpy.ones(3) * radius
+        rows = self.tree.query_ball_point(center, halfwidth.max(), p=numpy.inf)
+        rows = numpy.sort(numpy.asarray(rows, dtype=numpy.intp))
+        if halfwidth.min() < halfwidth.max():
+            offset = numpy.abs(self.tree.data[rows] - center)
+            rows = rows[(offset <= halfwidth).all(axis=1)]
+        return rows
+
+    def query_nearest(self, point, k=1):
+        """
+        Return the distances to and row numbers of the k particles nearest
+        to 'point'.
+        """
+        return self.tree.query(point, k)
+
+    @property
+    def id_index(self):
+        """
+        Sorted particle IDs and the row of each, as (ids, rows).  Built
+        with a single argsort on first use and rebuilt after particles are
+        dropped by refine_dataset.
+        """
+        try:
+            return vars(self)['_id_index']
+        except KeyError:
+            if 'particleIDs' in self.columns:
+                ids = self['particleIDs'].values
+            else:
+                ids = self._read_field('particleIDs')
+            order = numpy.argsort(ids, kind='mergesort')
+            vars(self)['_id_index'] = (ids[order], order)
+            return vars(self)['_id_index']
+
+    def rows_for_ids(self, ids):
+        """
+        Return the row numbers of the particles with the given IDs, or -1
+        for IDs not present.  Rows are positions in the frame, for use
+        with iloc.  Raises ValueError for IDs that are not non-negative
+        integers.
+        """
+        sorted_ids, order = self.id_index
+        ids = numpy.asarray(ids)
+        if ids.size == 0:
+            return numpy.full(ids.shape, -1, dtype=numpy.intp)
+        if ids.dtype.kind not in 'iu' or ids.min() < 0:
+            raise ValueError('Particle IDs must be non-negative integers.')
+        rows = numpy.full(ids.shape, -1, dtype=numpy.intp)
+        if sorted_ids.size == 0:
+            return rows
+        # IDs beyond the range of the file's ID type match nothing.
+        valid = ids <= numpy.iinfo(sorted_ids.dtype).max
+        valid_ids = ids[valid].astype(sorted_ids.dtype)
+        pos = numpy.searchsorted(sorted_ids, valid_ids)
+        pos = numpy.minimum(pos, sorted_ids.size - 1)
+        rows[valid] = numpy.where(sorted_ids[pos] == valid_ids, order[pos], -1)
+        return rows
+
+    def read_particles(self, ids, fields):
+        """
+        Return 'fields' of the particles with the given IDs, reading only
+        their rows from the snapshot file (in the current units).  Fields
+        already loaded are taken from the frame instead.
+        ids: particle IDs.
+        fields: field names, e.g. ['masses', 'coordinates', 'density'].
+        Returns a DataFrame indexed by particle ID, in the order of 'ids';
+        IDs not present get NaN values.
+        """
+        ids = numpy.asarray(ids)
+        rows = self.rows_for_ids(ids)
+        found = rows >= 0
+        rows = rows[found]
+        # Row numbers in the file, read in increasing order.
+        file_rows = numpy.asarray(self.index)[rows]
+        order = numpy.argsort(file_rows, kind='mergesort')
+        particles = DataFrame(index=Index(ids, name='particleIDs'))
+        for field in fields:
+            columns = self._vector_columns.get(field, field)
+            loaded = [columns] if isinstance(columns, basestring) else columns
+            if set(loaded).issubset(self.columns):
+                data = self[columns].values[rows]
+            else:
+                dataset = self._mapped(self._dataset(field))
+                if isinstance(dataset, numpy.ndarray):
+                    block = dataset[file_rows[order]]
+                else:
+                    block = read_rows(dataset, file_rows[order])
+                block = scale(block, self._conversion_factor(field),
+                              self._dtype)
+                data = numpy.empty_like(block)
+                data[order] = block
+            if not found.all():
+                dtype = data.dtype if data.dtype.kind == 'f' else numpy.float64
+                filled = numpy.full((ids.size,) + data.shape[1:], numpy.nan,
+                                    dtype)
+                filled[found] = data
+                data = filled
+            if isinstance(columns, basestring):
+                particles[columns] = data
+            else:
+                for i, column in enumerate(columns):
+                    particles[column] = data[:, i]
+        return particles
+
+    def _dataset(self, field):
+        """
+        Return the HDF5 dataset holding 'field'.
+        """
+        try:
+            return vars(self)['_'+field.replace(' ', '_')]
+        except KeyError:
+            raise KeyError("No dataset for field '%s'" %field)
+
+    def _conversion_factor(self, field):
+        """
+        Return the factor converting 'field' from code units to the
+        current units, or None if the field is not converted.
+        """
+        return self.units.conversion_factor(field, self._header)
+
+    def iter_chunks(self, fields, chunk_size=CHUNK_SIZE):
+        """
+        Iterate over blocks of particles, reading directly from the
+        snapshot file without loading whole columns.
+        fields: field name, or list of field names (e.g. 'masses',
+                'coordinates', 'density').
+        chunk_size: number of particles per block.
+        Yields a unit-converted array for a single field, or a tuple of
+        arrays for a list of fields.  Region and refinement selections
+        are respected.
+        """
+        single = isinstance(fields, basestring)
+        if single:
+            fields = [fields]
+        datasets = [self._mapped(self._dataset(field)) for field in fields]
+        factors = [self._conversion_factor(field) for field in fields]
+        rows = self._rows
+        if rows is None:
+            npart = datasets[0].shape[0]
+        else:
+            npart = rows.size
+        for start in xrange(0, npart, chunk_size):
+            stop = start + chunk_size
+            blocks = []
+            for dataset, factor in zip(datasets, factors):
+                if rows is None:
+                    block = dataset[start:stop]
+                elif isinstance(dataset, numpy.ndarray):
+                    block = dataset[rows[start:stop]]
+                else:
+                    block = read_rows(dataset, rows[start:stop])
+                if self._mask is not None:
+                    block = block[self._mask[start:stop]]
+                blocks.append(scale(block, factor, self._dtype))
+            if single:
+                yield blocks[0]
+            else:
+                yield tuple(blocks)
+
+    def _set_field(self, columns, data):
+        """
+        Store particle data read by _read_dataset as column(s).  Data are
+        aligned with the frame by position, not by index.
+        columns: column name, or list of names for vector quantities.
+        """
+        if isinstance(columns, list):
+            for i, column in enumerate(columns):
+                self[column] = data[:, i]
+            self._pristine.update(columns)
+        else:
+            self[columns] = data
+            self._pristine.add(columns)
+
     def refine_dataset(self, criterion):
-        self._drop_ids = self[criterion].index
-        self.drop(self._drop_ids, inplace=True)
+        """
+        Drop particles for which 'criterion' (a boolean array aligned with
+        the frame) is True.  Columns loaded afterwards are refined with the
+        same mask as they are read.
+        """
+        drop = numpy.asarray(criterion, dtype=bool)
+        if self._mask is None:
+            vars(self)['_mask'] = numpy.ones(len(self), dtype=bool)
+        kept = numpy.flatnonzero(self._mask)
+        self._mask[kept[drop]] = False
+        vars(self).pop('_selection', None)
+        self.drop(self.index[drop], inplace=True)
+        vars(self).pop('_tree', None)
+        vars(self).pop('_id_index', None)
+        if '_arrays' in vars(self):
+            self._arrays._refine(~drop)
         print self.index.size, 'particles selected.'
 
     def load_PIDs(self):
         """
         Load Particle ID numbers
         """
-        particleIDs = self._particleIDs.value
-        if self._drop_ids is not None:
-            particleIDs = Series(particleIDs, index=self._particleIDs.value)
-            self['particleIDs'] = particleIDs.drop(self._drop_ids)
-        else:
-            self['particleIDs'] = particleIDs
+        self._set_field('particleIDs', self._read_field('particleIDs'))
 
     def get_PIDs(self):
         """
@@ -101,12 +934,14 @@ class PartType(DataFrame):
         keys: arbitrary number of keys from the list.
         """
         for key in keys:
+            if key in self._derived_fields():
+                self.get_derived(key)
+                continue
             try:
                 load_func = self._load_dict[key]
                 load_func()
             except(KeyError):
-                hdf5key = '_'+key.replace(' ', '_')
-                self[key] = vars(self)[hdf5key].value
+                self._set_field(key, self._read_field(key))
 
     def load_all(self):
         """
@@ -119,10 +954,9 @@ class PartType(DataFrame):
         Clean up loaded data to save memory.
         exclude: properties to leave loaded.
         """
-        if 'coordinates' in exclude:
-            exclude += ('x', 'y', 'z')
-        if 'velocities' in exclude:
-            exclude += ('u', 'v', 'w')
+        for vector, columns in self._vector_columns.items():
+            if vector in exclude:
+                exclude += tuple(columns)
         to_drop = [key for key in self.columns if key not in exclude]
         self.drop(to_drop, axis=1, inplace=True)
 
@@ -154,3 +988,84 @@ class PartType(DataFrame):
         # Cleanup to save memory
         if kwargs.pop('cleanup', False):
             self.cleanup(*properties)
+
+class ParticleArrays(object):
+    """
+    Struct-of-arrays store for the particles of a PartType, as an
+    alternative to its DataFrame columns.  Each field is held as one
+    contiguous NumPy array aligned by position; vector fields such as
+    'coordinates' and 'velocities' are (N,3) arrays.  Fields are read and
+    unit-converted from the snapshot on first access, and respect the
+    region and refinement selections of the parent PartType.
+
+    Arrays are stored independently of the DataFrame columns; use
+    to_dataframe() to obtain a pandas DataFrame.
+    """
+    def __init__(self, ptype):
+        self._ptype = ptype
+        self._fields = {}
+
+    def __len__(self):
+        return len(self._ptype)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __getitem__(self, key):
+        try:
+            return self._fields[key]
+        except KeyError:
+            self._fields[key] = self._ptype._read_field(key)
+            return self._fields[key]
+
+    def __setitem__(self, key, value):
+        value = numpy.asarray(value)
+        if value.shape[0] != len(self):
+            raise ValueError('Expected %d particles, got %d.'
+                             %(len(self), value.shape[0]))
+        self._fields[key] = value
+
+    def __delitem__(self, key):
+        del self._fields[key]
+
+    def keys(self):
+        """
+        Return the names of fields currently held in memory.
+        """
+        return self._fields.keys()
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self._fields.values())
+
+    def load(self, *keys):
+        """
+        Load an arbitrary number of fields.
+        """
+        for key in keys:
+            self[key]
+
+    def _refine(self, keep):
+        for key in self._fields:
+            self._fields[key] = self._fields[key][keep]
+
+    def to_dataframe(self, *keys):
+        """
+        Return the requested fields (default: all loaded fields) as a
+        DataFrame indexed like the parent PartType.  Vector fields are
+        split into columns, e.g. 'coordinates' into x, y, z.
+        """
+        if not keys:
+            keys = self.keys()
+        frame = DataFrame(index=self._ptype.index)
+        for key in keys:
+            data = self[key]
+            if data.ndim > 1:
+                columns = self._ptype._vector_columns.get(key)
+                if columns is None:
+                    columns = ['%s_%d' %(key, i) for i in range(data.shape[1])]
+                for i, column in enumerate(columns):
+                    frame[column] = data[:, i]
+            else:
+                frame[key] = data
+        return frame
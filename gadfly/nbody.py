@@ -7,7 +7,7 @@ particle data.
 import numpy
 from pandas import Series, DataFrame
 
-from hdf5 import PartType
+from hdf5 import PartType, derived_field
 import units
 import coordinates
 import analyze
@@ -34,6 +34,7 @@ class PartTypeNbody(PartType):
         del result['_masses']
         del result['_load_dict']
         del result['loadable_keys']
+        result.pop('_tree', None)
         del result['_calculated']
         return result
 
@@ -68,15 +69,8 @@ class PartTypeNbody(PartType):
         """
         if unit:
             self.units.set_mass(unit)
-        masses = self._masses.value * self.units.mass_conv
-        if self.units.remove_h:
-            h = self._header.HubbleParam
-            masses /= h
-        if self._drop_ids is not None:
-            masses = Series(masses, index=self._particleIDs.value)
-            self['masses'] = masses.drop(self._drop_ids)
-        else:
-            self['masses'] = masses
+        masses = self._read_field('masses')
+        self._set_field('masses', masses)
 
     def get_masses(self, unit=None):
         """
@@ -99,17 +93,8 @@ class PartTypeNbody(PartType):
         """
         if unit:
             self.units._set_coord_length(unit)
-        xyz = self._coordinates.value * self.units.length_conv
-        if self.units.remove_h:
-            h = self._header.HubbleParam
-            xyz /= h
-        if self.units.coordinate_system == 'physical':
-            a = self._header.ScaleFactor
-            xyz *= a
-        xyz = DataFrame(xyz, index=self._particleIDs.value, columns=['x', 'y', 'z'])
-        if self._drop_ids is not None:
-            xyz.drop(self._drop_ids, inplace=True)
-        self[['x', 'y', 'z']] = xyz
+        xyz = self._read_field('coordinates')
+        self._set_field(['x', 'y', 'z'], xyz)
 
     def load_velocities(self, unit=None):
         """
@@ -118,14 +103,8 @@ class PartTypeNbody(PartType):
         """
         if unit:
             self.units.set_velocity(unit)
-        uvw = self._velocities.value * self.units.velocity_conv
-        if self.units.coordinate_system == 'physical':
-            a = self._header.ScaleFactor
-            uvw *= numpy.sqrt(a)
-        uvw = DataFrame(uvw, index=self._particleIDs.value, columns=['u', 'v', 'w'])
-        if self._drop_ids is not None:
-            uvw.drop(self._drop_ids, inplace=True)
-        self[['u', 'v', 'w']] = uvw
+        uvw = self._read_field('velocities')
+        self._set_field(['u', 'v', 'w'], uvw)
 
     def orient_box(self, **kwargs):
         """
@@ -158,9 +137,12 @@ class PartTypeNbody(PartType):
                 except AttributeError:
                     raise KeyError("Cannot density-center dark matter!")
                 pos_vel = analyze.center_box(pos_vel, density=dens, **kwargs)
+            elif centering == 'shrink':
+                pos_vel = analyze.center_box(pos_vel, mass=self.masses.values,
+                                             tree=vars(self).get('_tree'),
+                                             **kwargs)
             elif centering == 'box':
                 pos_vel = analyze.center_box(pos_vel, **kwargs)
-        self[pos_vel.keys()] = pos_vel
 
         if view:
             print 'Rotating Box...'
@@ -169,13 +151,16 @@ class PartTypeNbody(PartType):
                     dens = self.get_number_density()
                 except AttributeError:
                     raise KeyError("Cannot density-center dark matter!")
-                xyz, uvw = visualize.set_view(view, self[xyz], velocity=self[uvw],
-                                               density=dens, dens_lim=dlim)
+                rot = visualize.view_matrix(view, pos_vel[xyz],
+                                            velocity=pos_vel[uvw],
+                                            density=dens, dens_lim=dlim)
             else:
-                xyz, uvw = visualize.set_view(view, self[xyz], velocity=self[uvw])
+                rot = coordinates.view_matrix(view)
+            # Rotate positions and velocities together as one (N,6) block.
+            pos_vel = numpy.ascontiguousarray(pos_vel[xyz + uvw].values)
+            coordinates.transform(pos_vel, rot)
             print 'Rotation complete.'
-            self[['x', 'y', 'z']] = xyz
-            self[['u', 'v', 'w']] = uvw
+        self[xyz + uvw] = self._as_dtype(pos_vel)
 
     def calculate_spherical_coords(self, c_unit=None, v_unit=None, **kwargs):
         """
@@ -213,6 +198,15 @@ class PartTypeNbody(PartType):
         print 'Converting to cylindrical coordinates...'
         coordinates.cartesian_to_cylindrical(self)
 
+    @derived_field('radius', 'coordinates')
+    def calculate_radius(self):
+        """
+        Calculate particle distances from the origin (the box center after
+        orient_box) in the current coordinate units.
+        """
+        xyz = self[['x', 'y', 'z']].values
+        return numpy.sqrt(numpy.einsum('ij,ij->i', xyz, xyz))
+
     def get_coords(self, unit=None, **kwargs):
         """
         Return Particle Coordinates in units of kpc (default set in units class)
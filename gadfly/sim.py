@@ -2,10 +2,12 @@
 # Jacob Hummel
 import os
 import glob
+import json
+import collections
+import h5py
 import numpy
+import pandas
 import subprocess
-import threading
-import Queue
 import multiprocessing as mp
 
 import units
@@ -15,6 +17,20 @@ class Simulation(object):
     """
     Class for simulations.  Primarily for gathering metadata such as file
     paths and unit coversions.
+
+    cache_bytes: memory budget for keeping opened snapshots (and the data
+                 loaded from them) between load_snapshot calls.  Default 0
+                 (no caching).
+    field_cache: if True, store fields read from snapshots, converted to
+                 the current units, and derived fields calculated from
+                 them, in .npy files under savepath/field_cache, and
+                 memory-map them on later runs instead of recomputing.
+    memmap (default True): read uncompressed, contiguous datasets through
+            a memory map of the snapshot file rather than copying them.
+    dtype: floating point precision to hold particle fields in, e.g.
+           'float32' to halve memory for single precision snapshots.
+           Default None: the precision of the file, promoted only where
+           a unit conversion needs it.
     """
     def __init__(self, path, **simargs):
         super(Simulation,self).__init__()
@@ -37,6 +53,18 @@ class Simulation(object):
         self.units.set_coordinate_system(self.coordinates)
 
         self.snapfiles = self.find_snapshots(self.snapfile_base)
+        # Opened snapshots, least recently used first.  Disabled if the
+        # budget is 0.
+        self.cache_bytes = simargs.pop('cache_bytes', 0)
+        self.field_cache = simargs.pop('field_cache', False)
+        self.memmap = simargs.pop('memmap', True)
+        self.dtype = simargs.pop('dtype', None)
+        self._snapshot_cache = collections.OrderedDict()
+
+    def __getstate__(self):
+        result = self.__dict__.copy()
+        result['_snapshot_cache'] = collections.OrderedDict()
+        return result
 
     def set_field_names(self, name_dict={}):
         self.hdf5_fields = {'particleIDs':'ParticleIDs',
@@ -65,14 +93,21 @@ class Simulation(object):
             raise KeyError
 
     def find_snapshots(self, snapfile_base, *nums):
-        files0 = glob.glob(self.filepath+'/'+snapfile_base+'_???.hdf5')
-        files1 = glob.glob(self.filepath+'/'+snapfile_base+'_????.hdf5')
-        files0.sort()
-        files1.sort()
-        files = files0 + files1
+        """
+        Return a dictionary of snapshot files keyed by snapshot number.
+        Multi-file snapshots (snapshot_NNN.K.hdf5) are listed by their
+        first piece.
+        """
+        files = []
+        for suffix in ['_???.hdf5', '_????.hdf5',
+                       '_???.0.hdf5', '_????.0.hdf5']:
+            found = glob.glob(self.filepath+'/'+snapfile_base+suffix)
+            found.sort()
+            files += found
         snapfiles = {}
         for f in files:
-            num = int(f[:-5].split('_')[-1])
+            f_base = os.path.basename(f).replace('.hdf5','')
+            num = int(f_base.split('_')[-1].split('.')[0])
             if nums:
                 if num in nums:
                     snapfiles[num] = f
@@ -80,24 +115,103 @@ class Simulation(object):
                 snapfiles[num] = f
         return snapfiles
 
+    def catalog(self, update=True):
+        """
+        Return a DataFrame, indexed by snapshot number, of header values
+        (Time, Redshift, BoxSize, NumPart_Total_0..5) for every snapshot.
+        Only the Header group of each file is read.  Values are cached in a
+        sidecar file in self.savepath and re-read only for snapshots with a
+        file (any piece of a multi-file snapshot) whose modification time
+        or size has changed.
+        update: if False, do not write the sidecar file.
+        """
+        fname = os.path.join(self.savepath, self.snapfile_base+'_catalog.json')
+        try:
+            with open(fname) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            cache = {}
+        changed = False
+        rows = {}
+        for num, snapfile in self.snapfiles.items():
+            stamp = []
+            for piece in _snapshot_pieces(snapfile):
+                stat = os.stat(piece)
+                stamp.append([os.path.basename(piece), stat.st_mtime,
+                              stat.st_size])
+            key = os.path.basename(snapfile)
+            entry = cache.get(key)
+            if entry is None or entry.get('stamp') != stamp:
+                entry = {'stamp':stamp,
+                         'header':read_header_summary(snapfile)}
+                cache[key] = entry
+                changed = True
+            rows[num] = entry['header']
+        if changed and update:
+            try:
+                with open(fname+'.tmp', 'w') as f:
+                    json.dump(cache, f)
+                os.rename(fname+'.tmp', fname)
+            except (IOError, OSError):
+                print 'Warning: could not write snapshot catalog', fname
+        columns = ['Time', 'Redshift', 'BoxSize']
+        columns += ['NumPart_Total_%d' %ptype for ptype in range(6)]
+        catalog = pandas.DataFrame.from_dict(rows, orient='index')
+        return catalog.reindex(columns=columns).sort_index()
+
+    def select_snapshots(self, zmin=None, zmax=None):
+        """
+        Return the sorted numbers of snapshots with zmin <= redshift <= zmax,
+        using the header catalog.
+        """
+        catalog = self.catalog()
+        selected = numpy.ones(len(catalog), dtype=bool)
+        if zmin is not None:
+            selected &= (catalog.Redshift >= zmin).values
+        if zmax is not None:
+            selected &= (catalog.Redshift <= zmax).values
+        return list(catalog.index[selected])
+
     def set_snapshots(self, *nums):
-        self.snapfiles = self.find_snapshots(*nums)
+        self.snapfiles = self.find_snapshots(self.snapfile_base, *nums)
 
     def load_snapshot(self, num, *load_keys,**kwargs):
+        """
+        Open snapshot number 'num'.
+        refine_gas, refine_nbody: refine to highest resolution particles.
+        region: (center, radius) in the current coordinate units.  If set,
+                only particles inside the region are read from the file.
+        region_shape: 'sphere' (default) or 'box'.  For a box, radius is
+                      the half-width (scalar or one per axis).
+        cache (default True): if the simulation has a cache budget
+               (cache_bytes), return the cached snapshot opened with the
+               same options, with any data it has already loaded.
+        """
+        cache = kwargs.pop('cache', True) and self.cache_bytes > 0
         if ((kwargs.pop('refine_gas',False)) or self.refine_gas):
             kwargs['refine_gas'] = True
         if ((kwargs.pop('refine_nbody',False)) or self.refine_nbody):
             kwargs['refine_nbody'] = True
+        if cache:
+            key = self._cache_key(num, kwargs)
+            snap = self._snapshot_cache.pop(key, None)
+            if snap is not None and snap.is_open():
+                self._snapshot_cache[key] = snap
+                self.trim_cache()
+                return snap
 
         try:
             fname = self.snapfiles[num]
         except KeyError:
             try:
-                fname = self.find_snapshots(num)[num]
+                fname = self.find_snapshots(self.snapfile_base, num)[num]
             except KeyError:
                 raise IOError('Sim ' + self.name + ' snapshot '
                               + str(num) + ' not found!')
         snap = snapshot.File(self, fname, **kwargs)
+        if cache:
+            self._snapshot_cache[key] = snap
+            self.trim_cache()
 
         #if load_keys:
         #    snap.gas.load_data(*load_keys,**kwargs)
@@ -105,78 +219,168 @@ class Simulation(object):
         #    snap.gas.cleanup()
         return snap
 
+    def _cache_key(self, num, load_args):
+        """
+        Key for the snapshot cache: snapshot number, unit settings, dtype
+        and the load options.
+        """
+        options = []
+        for name, value in sorted(load_args.items()):
+            if not isinstance(value, basestring):
+                try:
+                    value = tuple(numpy.ravel(value).tolist())
+                except TypeError:
+                    value = tuple(repr(v) for v in value)
+            options.append((name, value))
+        dtype = numpy.dtype(self.dtype).str if self.dtype else None
+        return (num, self.units.settings(), dtype, tuple(options))
+
+    def trim_cache(self, cache_bytes=None):
+        """
+        Close least recently used cached snapshots until the loaded data
+        of those left fits in cache_bytes (default self.cache_bytes).  The
+        most recently used snapshot is always kept.
+        """
+        if cache_bytes is None:
+            cache_bytes = self.cache_bytes
+        keys = list(self._snapshot_cache.keys())
+        sizes = [self._snapshot_cache[key].nbytes for key in keys]
+        total = sum(sizes)
+        for key, size in zip(keys[:-1], sizes[:-1]):
+            if total <= cache_bytes:
+                break
+            self._snapshot_cache.pop(key).close()
+            total -= size
+
+    def clear_cache(self):
+        """
+        Close and forget all cached snapshots.
+        """
+        while self._snapshot_cache:
+            self._snapshot_cache.popitem(last=False)[1].close()
+
     def multitask(self, task, *data, **kwargs):
-        maxprocs = mp.cpu_count() - 1
-        file_queue = mp.Queue()
-        data_queue = mp.Queue(maxprocs/4)
-        loader = snapshot.Loader(self.load_snapshot, file_queue, data_queue)
-        loader.start()
-        snaps = self.snapfiles.keys()
-        snaps.sort()
-        for snap in snaps:
-            args = (snap,)+data
-            file_queue.put(args)
-        for i in range(maxprocs):
-            file_queue.put(None)
-
-        jobs = []
-        if kwargs.pop('parallel', True):
-            for i in range(maxprocs):
-                p = mp.Process(target=self.controller,
-                               args=(task,data_queue))
-                p.start()
-                jobs.append(p)
-            for process in jobs:
-                process.join()
+        """
+        Run task(snapshot, *data) on a series of snapshots in parallel.
+        Each worker process opens its own snapshot file, runs the task, and
+        sends back only the task's return value, so no snapshot data is
+        passed between processes.  'task' must be picklable, i.e. defined
+        at module level.
 
-        else:
-            file_queue.put(None)
-            self.controller(task, data_queue)
+        snapshots: snapshot numbers to process (default: all).
+        nprocs: number of worker processes (default: number of cpus - 1).
+        parallel (default True): if False, run in this process.
+        verbose (default True): print progress.
+        Remaining kwargs are passed to load_snapshot.
 
-    def controller(self, task, data_queue):
-        print "Starting compute process..."
-        done = False
-        while not done:
+        Returns a dictionary of task results keyed by snapshot number.
+        """
+        nums = sorted(kwargs.pop('snapshots', self.snapfiles.keys()))
+        nprocs = kwargs.pop('nprocs', max(mp.cpu_count() - 1, 1))
+        parallel = kwargs.pop('parallel', True)
+        verbose = kwargs.pop('verbose', True)
+        jobs = [(self, num, task, data, kwargs) for num in nums]
+        results = {}
+        if parallel and nprocs > 1 and len(jobs) > 1:
+            pool = mp.Pool(min(nprocs, len(jobs)))
             try:
-                snap = data_queue.get()
-            except Queue.Empty:
-                break
-            if snap is None:
-                done = True
-                break
-            else:
-                wp = self.plotpath + self.name
-                task(snap, wp)
-        print "Compute process complete."
+                finished = pool.imap_unordered(_run_task, jobs)
+                for i, (num, result) in enumerate(finished):
+                    results[num] = result
+                    if verbose:
+                        print 'Snapshot %d done (%d/%d)' %(num, i+1, len(jobs))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for i, job in enumerate(jobs):
+                num, result = _run_task(job)
+                results[num] = result
+                if verbose:
+                    print 'Snapshot %d done (%d/%d)' %(num, i+1, len(jobs))
+        return results
+
+    def track(self, ids, fields, snapshots=None, **kwargs):
+        """
+        Follow the particles with the given IDs through a series of
+        snapshots.  Besides the particle IDs, only the rows of the tracked
+        particles are read from each snapshot (see PartType.read_particles).
+
+        ids: particle IDs.
+        fields: fields to read, e.g. ['masses', 'coordinates'].
+        snapshots: snapshot numbers (default: all).
+        ptype: 'gas' (default) or 'dm'.
+        Remaining kwargs are passed to multitask (nprocs, parallel,
+        verbose) and load_snapshot.
+
+        Returns a DataFrame indexed by (snapshot, particle ID), with the
+        snapshot Time and Redshift as columns.
+        """
+        ptype = kwargs.pop('ptype', 'gas')
+        if snapshots is not None:
+            kwargs['snapshots'] = snapshots
+        results = self.multitask(_track_particles, ptype, numpy.asarray(ids),
+                                 list(fields), **kwargs)
+        nums = [num for num in sorted(results) if results[num] is not None]
+        if not nums:
+            return pandas.DataFrame()
+        return pandas.concat([results[num] for num in nums], keys=nums,
+                             names=['snapshot', 'particleIDs'])
 
 #===============================================================================
-class Loader(threading.Thread):
-    def __init__(self, load_function, file_queue, data_queue):
-        self.file_queue = file_queue
-        self.data_queue = data_queue
-        self.load_function = load_function
-        threading.Thread.__init__(self)
-
-    def run(self):
-        lock = threading.Lock()
-        while 1:
-            try:
-                args = self.file_queue.get(timeout=1)
-            except Queue.Empty:
-                break # reached end of queue
-            if args is None:
-                self.data_queue.put(None)
-            else:
-                fname = args[0]
-                lock.acquire()
-                print 'loading snapshot', fname
-                lock.release()
-                try:
-                    snapshot = self.load_function(*args)
-                    snapshot.close()
-                    self.data_queue.put(snapshot)
-                except IOError:
-                    lock.acquire()
-                    print 'Warning: snapshot '+str(fname)+' not found!'
-                    lock.release()
-                    pass
+def _snapshot_pieces(snapfile):
+    """
+    Files of the snapshot whose first (or only) file is 'snapfile': all
+    pieces snapshot_NNN.K.hdf5 of a multi-file snapshot, in piece order.
+    """
+    if not snapfile.endswith('.0.hdf5'):
+        return [snapfile]
+    base = snapfile[:-len('.0.hdf5')]
+    number = lambda f: f[len(base)+1:-len('.hdf5')]
+    pieces = [f for f in glob.glob(base+'.*.hdf5') if number(f).isdigit()]
+    return sorted(pieces, key=lambda f: int(number(f)))
+
+def read_header_summary(snapfile):
+    """
+    Read Time, Redshift, BoxSize and total particle numbers from the
+    header of a snapshot file, without touching any particle data.
+    """
+    with h5py.File(snapfile, 'r') as f:
+        attrs = f['Header'].attrs
+        npart = [int(n) for n in attrs['NumPart_Total']]
+        if 'NumPart_Total_HighWord' in attrs:
+            high = attrs['NumPart_Total_HighWord']
+            npart = [n + (int(hw) << 32) for n, hw in zip(npart, high)]
+        summary = {'Time':float(attrs['Time']),
+                   'Redshift':float(attrs['Redshift']),
+                   'BoxSize':float(attrs['BoxSize'])}
+    for ptype, n in enumerate(npart):
+        summary['NumPart_Total_%d' %ptype] = n
+    return summary
+
+#===============================================================================
+def _run_task(job):
+    """
+    Worker for Simulation.multitask: open one snapshot, run the task on
+    it and return (snapshot number, result).
+    """
+    sim, num, task, data, load_args = job
+    try:
+        snap = sim.load_snapshot(num, **load_args)
+    except IOError:
+        print 'Warning: snapshot '+str(num)+' not found!'
+        return num, None
+    try:
+        return num, task(snap, *data)
+    finally:
+        snap.close()
+
+def _track_particles(snap, ptype, ids, fields):
+    """
+    Task for Simulation.track: read 'fields' of the tracked particles from
+    one snapshot.
+    """
+    particles = getattr(snap, ptype).read_particles(ids, fields)
+    particles['Time'] = snap.header.Time
+    particles['Redshift'] = snap.header.Redshift
+    return particles
@@ -10,20 +10,33 @@ import Queue
 import h5py
 import numpy
 
-from hdf5 import Header
+from hdf5 import Header, MultiFile, PartType
 from nbody import PartTypeNbody
 from sph import PartTypeSPH
 
 class File(object):
     """
     Class for Gadget2 HDF5 snapshot files.
+
+    Snapshots written in several pieces (snapshot_NNN.K.hdf5) are opened
+    from their first piece and treated as a single snapshot.
+    read_threads: maximum number of pieces to read concurrently.
     """
     def __init__(self, sim, filename, **kwargs):
         self.sim = sim
         self.filename = filename
-        f = filename.replace('.hdf5','')
-        self.number = int(f.split('_')[-1])
+        f = os.path.basename(filename).replace('.hdf5','')
+        self.number = int(f.split('_')[-1].split('.')[0])
         self.file_id = h5py.File(filename, 'r')
+        nfiles = self.file_id['Header'].attrs.get('NumFilesPerSnapshot', 1)
+        threads = kwargs.pop('read_threads', None)
+        if nfiles > 1:
+            self.file_id.close()
+            base = filename[:-len('.0.hdf5')]
+            self.filenames = ['%s.%d.hdf5' %(base, i) for i in range(nfiles)]
+            self.file_id = MultiFile(self.filenames, threads)
+        else:
+            self.filenames = [filename]
         self.header = Header(self.file_id)
         kwargs['refine'] = kwargs.pop('refine_nbody', False)
         self.define_ptype('dm', 1, PartTypeNbody, **kwargs)
@@ -42,7 +55,18 @@ class File(object):
     def keys(self):
         for key in self.file_id.keys():
             print key
-        
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the loaded particle data, in bytes.
+        """
+        return sum(value.nbytes for value in vars(self).values()
+                   if isinstance(value, PartType))
+
+    def is_open(self):
+        return bool(self.file_id)
+
     def close(self):
         try:
             self.file_id.close()
@@ -6,8 +6,10 @@ This module contains classes for reading Gadget2 SPH particle data.
 import numpy
 from pandas import Series, DataFrame
 
+from hdf5 import derived_field
 from nbody import PartTypeNbody
 import units
+import constants
 
 class PartTypeSPH(PartTypeNbody):
     """
@@ -35,6 +37,7 @@ class PartTypeSPH(PartTypeNbody):
         del result['_internal_energy']
         del result['_load_dict']
         del result['loadable_keys']
+        result.pop('_tree', None)
         return result
 
     def __setstate__(self, in_dict):
@@ -66,18 +69,8 @@ class PartTypeSPH(PartTypeNbody):
         """
         if unit:
             self.units.set_density(unit)
-        density = self._density.value * self.units.density_conv
-        if self.units.remove_h:
-            h = self._header.HubbleParam
-            density *=  h**2
-        if self.units.coordinate_system == 'physical':
-            ainv = self._header.Redshift + 1 # 1/(scale factor)
-            density *= ainv**3
-        if self._drop_ids is not None:
-            density = Series(density, index=self._particleIDs.value)
-            self['density'] = density.drop(self._drop_ids)
-        else:
-            self['density'] = density
+        density = self._read_field('density')
+        self._set_field('density', density)
 
     def get_density(self, unit=None):
         """
@@ -93,6 +86,19 @@ class PartTypeSPH(PartTypeNbody):
             self.load_density(unit)
             return self.density
 
+    @derived_field('ndensity', 'density', units=['density_unit'])
+    def calculate_number_density(self):
+        """
+        Calculate hydrogen number densities in particles/cc.
+        """
+        return self.density * constants.X_h / constants.m_H
+
+    def get_number_density(self):
+        """
+        Return hydrogen number densities in particles/cc.
+        """
+        return self.get_derived('ndensity')
+
     def load_internal_energy(self, unit=None):
         """
         Load internal particle energies per unit mass in cgs units 
@@ -101,12 +107,8 @@ class PartTypeSPH(PartTypeNbody):
         """
         if unit:
             self.units.set_energy(unit)
-        energy = self._internal_energy.value * self.units.energy_conv
-        if self._drop_ids is not None:
-            energy = Series(energy, index=self._particleIDs.value)
-            self['internal_energy'] = energy.drop(self._drop_ids)
-        else:
-            self['internal_energy'] = energy
+        energy = self._read_field('internal_energy')
+        self._set_field('internal_energy', energy)
 
     def get_internal_energy(self, unit=None):
         """
@@ -130,18 +132,8 @@ class PartTypeSPH(PartTypeNbody):
         """
         if unit:
             self.units._set_smoothing_length(unit)
-        hsml = self._smoothing_length.value * self.units.length_conv
-        if self.units.remove_h:
-            h = self._header.HubbleParam
-            hsml /= h
-        if self.units.coordinate_system == 'physical':
-            a = self._header.ScaleFactor
-            hsml *= a
-        if self._drop_ids is not None:
-            hsml = Series(hsml, index=self._particleIDs.value)
-            self['smoothing_length'] = hsml.drop(self._drop_ids)
-        else:
-            self['smoothing_length'] = hsml
+        hsml = self._read_field('smoothing_length')
+        self._set_field('smoothing_length', hsml)
 
     def get_smoothing_length(self, unit=None):
         """
@@ -8,6 +8,16 @@ Physical cgs unit conversions for analyzing my Gadget2 HDF5 snapshot data.
 ### Unit Selection Dictionaries
 
 class Units(object):
+    # Snapshot fields converted on loading: the attribute holding the
+    # conversion from code units, and the powers of h and of the scale
+    # factor a folded into it (when removing h, and in physical coordinates).
+    field_scalings = {'masses':('mass_conv', -1, 0),
+                      'coordinates':('length_conv', -1, 1),
+                      'smoothing_length':('length_conv', -1, 1),
+                      'velocities':('velocity_conv', 0, 0.5),
+                      'density':('density_conv', 2, -3),
+                      'internal_energy':('energy_conv', 0, 0)}
+
     def __init__(self, **unitargs):
         super(Units,self).__init__()
 
@@ -100,6 +110,33 @@ class Units(object):
         self.energy_unit = unit
         self.energy_conv = self.energies[self.energy_unit]
 
+    def settings(self):
+        """
+        Return the current unit settings (units, conversions, coordinate
+        system, h removal) as a hashable tuple.
+        """
+        return tuple(sorted((key, value) for key, value in vars(self).items()
+                            if isinstance(value, (basestring, bool, int,
+                                                  float))))
+
+    def conversion_factor(self, field, header):
+        """
+        Return the single factor converting 'field' from code units to the
+        current units, including its factors of h and the scale factor, or
+        None if the field is not converted.
+        header: snapshot header (HubbleParam, ScaleFactor).
+        """
+        try:
+            conv, h_power, a_power = self.field_scalings[field]
+        except KeyError:
+            return None
+        conv = vars(self)[conv]
+        if self.remove_h and h_power:
+            conv *= header.HubbleParam**h_power
+        if self.coordinate_system == 'physical' and a_power:
+            conv *= header.ScaleFactor**a_power
+        return conv
+
     def convert_units(self, val, u1, u2):
         val /= self.lengths[u1]
         val *= self.lengths[u2]
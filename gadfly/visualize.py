@@ -4,222 +4,432 @@
 
 import os
 import sys
+import threading
+import tempfile
+import Queue
+import multiprocessing as mp
 import numpy
 import pandas
-from numba import jit
-from scipy import weave
-from scipy.weave import converters
+try:
+    import numba
+    from numba import jit, prange
+    NUM_THREADS = numba.config.NUMBA_NUM_THREADS
+except ImportError:
+    # Without numba the kernels below run as (slow) pure python.
+    numba = None
+    NUM_THREADS = 1
+    prange = xrange
+    def jit(*args, **kwargs):
+        return lambda func: func
 
 import analyze
 import coordinates
 #===============================================================================
-def scalar_map(y,x,scalar_field,hsml,width,pps,zshape):
+@jit(nopython=True, nogil=True)
+def _splat(zi, nzi, x, y, scalar, h, width, pps, i0=0, j0=0):
     """
-    code contains an algorithm for doing sph particle smoothing.
+    Add one particle to the image buffers zi and nzi with the cubic spline
+    kernel, weighted by scalar**2.  The buffers hold pixels i0, j0 onward
+    of the pps x pps grid (the whole grid, or one tile of it).  Only the
+    pixels of the particle's footprint, clipped to the buffers, are
+    visited.
     """
-    # !!!!! x and y are reversed in the c-code below - no idea why/how...
-    # !!!!! (Hence the reversal above)
-    zi = numpy.zeros(zshape)
-    nzi = numpy.zeros_like(zi)
-    N_gas = scalar_field.size
-    code = \
-        r"""
-        int procs, nthreads;
-        int i,j,n, i_min,i_max,j_min,j_max;
-        int flag_i = 0;
-        int flag_j = 0;
-        double center_i,center_j;
-        double r,r2,weight,W_x;
-
-        /* Get environment information */
-        procs = omp_get_num_procs();
-        nthreads = omp_get_num_threads();
-        /* Print environment information */
-        printf("Number of processors = %d\n", procs);
-                
-        #pragma omp parallel for \
-          private(n,i,j,i_min,i_max,j_min,j_max,flag_i,flag_j, \
-          center_i,center_j,r,r2,weight,W_x)
-        for(n =0; n < N_gas; n++) 
-          {
-            i = 0;
-            j = 0;
-            i_min = int((x(n) - hsml(n) + width/2.0) / width*pps);
-            i_max = int((x(n) + hsml(n) + width/2.0) / width*pps);
-            j_min = int((y(n) - hsml(n) + width/2.0) / width*pps);
-            j_max = int((y(n) + hsml(n) + width/2.0) / width*pps);
-            weight = scalar_field(n)*scalar_field(n);
-            do 
-              {
-                if(i >= i_min && i <= i_max)
-                  {
-                    flag_i = 1;
-                    center_i = -width/2.0 + (i+0.5) * width/ (double) pps;
-                    do
-                      {
-                        if(j >= j_min && j <= j_max)
-                          {
-                            flag_j = 1;
-                            center_j = -width/2.0 + (j+0.5)
-                              * width / (double) pps;
-                            r2 = ((x(n) - center_i) * (x(n) - center_i)
-                                  + (y(n) - center_j) * (y(n) - center_j))
-                              / hsml(n) / hsml(n);
-                            if(r2 <= 1.0)
-                              {
-                                r = sqrt(r2);
-                                if(r <= 0.5)
-                                  W_x = 1.0 - 6.0 * r*r + 6.0 * r*r*r;
-                                else
-                                  W_x = 2.0 * (1.0-r) * (1.0-r) * (1.0-r);
-                                zi(i,j) += weight * scalar_field(n) * W_x;
-                                nzi(i,j) += weight * W_x;
-                              }
-                          }
-                        else if(j > j_max)
-                          {
-                            flag_j = 2;
-                          }
-                        else
-                          {
-                            flag_j = 0;
-                          }
-                        j++;
-                      }
-                    while((flag_j == 0 || flag_j == 1) && j < pps);
-                    j = 0;
-                  }
-                else if(i > i_max)
-                  {
-                    flag_i = 2;
-                  }
-                else
-                  {
-                    flag_i = 0;
-                  }
-                i++;
-              }
-            while((flag_i == 0 || flag_i == 1) && i < pps);
-            i = 0;
-          }
-        """
-    weave.inline(code,
-                 ['pps','width','x','y','scalar_field',
-                  'hsml','zi','nzi','N_gas'],
-                 compiler='gcc',
-                 headers=['<stdio.h>','<math.h>','<omp.h>'],
-                 extra_compile_args=['-fopenmp ' ],
-                 libraries=['gomp'], type_converters=converters.blitz)
+    i_min = max(int((x - h + width/2.0) / width*pps), i0)
+    i_max = min(int((x + h + width/2.0) / width*pps), i0 + zi.shape[0]-1)
+    j_min = max(int((y - h + width/2.0) / width*pps), j0)
+    j_max = min(int((y + h + width/2.0) / width*pps), j0 + zi.shape[1]-1)
+    weight = scalar*scalar
+    wscalar = weight * scalar
+    inv_h2 = 1.0 / (h * h)
+    for i in range(i_min, i_max+1):
+        center_i = -width/2.0 + (i+0.5) * width/pps
+        dx2 = (x - center_i) * (x - center_i) * inv_h2
+        if dx2 > 1.0:
+            continue
+        for j in range(j_min, j_max+1):
+            center_j = -width/2.0 + (j+0.5) * width/pps
+            r2 = dx2 + (y - center_j)*(y - center_j) * inv_h2
+            if r2 <= 1.0:
+                r = numpy.sqrt(r2)
+                if r <= 0.5:
+                    W_x = 1.0 - 6.0 * r*r + 6.0 * r*r*r
+                else:
+                    W_x = 2.0 * (1.0-r) * (1.0-r) * (1.0-r)
+                zi[i-i0,j-j0] += wscalar * W_x
+                nzi[i-i0,j-j0] += weight * W_x
+
+@jit(nopython=True, nogil=True, parallel=True)
+def _deposit(x,y,scalar_field,hsml,width,pps,nthreads):
+    """
+    Deposit particles onto per-thread image buffers using the cubic spline
+    kernel.  Particles are split into 'nthreads' contiguous blocks, one
+    per buffer, so no two threads ever write to the same buffer.  The
+    buffers (zi and nzi) take nthreads*pps**2*16 bytes, e.g. 64 MB per
+    thread at pps = 2000; use tiled_map for larger images.
+    """
+    npart = scalar_field.size
+    zi = numpy.zeros((nthreads, pps, pps))
+    nzi = numpy.zeros((nthreads, pps, pps))
+    for t in prange(nthreads):
+        zi_t = zi[t]
+        nzi_t = nzi[t]
+        for n in range(t*npart//nthreads, (t+1)*npart//nthreads):
+            _splat(zi_t, nzi_t, x[n], y[n], scalar_field[n], hsml[n],
+                   width, pps)
+    return zi, nzi
+
+@jit(nopython=True, nogil=True, parallel=True)
+def _deposit_levels(x,y,z,scalar_field,hsml,widths,pps,sm,depth,nthreads):
+    """
+    Deposit particles onto the images of nested, concentric views of
+    decreasing 'widths' in a single pass over the particles.  Each
+    particle is added to every level whose view contains it, with its
+    smoothing length (times sm) floored at half a pixel of that level.
+    depth: view depth as a fraction of the width (0 for no limit).
+    """
+    npart = scalar_field.size
+    nlevels = widths.size
+    zi = numpy.zeros((nthreads, nlevels, pps, pps))
+    nzi = numpy.zeros((nthreads, nlevels, pps, pps))
+    for t in prange(nthreads):
+        for n in range(t*npart//nthreads, (t+1)*npart//nthreads):
+            for l in range(nlevels):
+                half = widths[l] / 2.0
+                # Levels are nested: a particle outside this view is
+                # outside all smaller ones.
+                if abs(x[n]) >= half or abs(y[n]) >= half:
+                    break
+                if depth > 0 and abs(z[n]) >= depth * half:
+                    break
+                h = max(sm * hsml[n], widths[l] / pps / 2.0)
+                _splat(zi[t,l], nzi[t,l], x[n], y[n], scalar_field[n], h,
+                       widths[l], pps)
+    return zi, nzi
+
+@jit(nopython=True, nogil=True)
+def _deposit_tile(x,y,scalar_field,hsml,rows,width,pps,i0,j0,ni,nj):
+    """
+    Deposit the particles 'rows' onto the ni x nj tile of the pps x pps
+    grid starting at pixel (i0, j0).  The scalar field may be single
+    precision; it is weighted in double precision, as in scalar_map.
+    """
+    zi = numpy.zeros((ni, nj))
+    nzi = numpy.zeros((ni, nj))
+    for n in rows:
+        _splat(zi, nzi, x[n], y[n], numpy.float64(scalar_field[n]), hsml[n],
+               width, pps, i0, j0)
+    return zi, nzi
+
+# Serial builds of the same kernels, safe to run from several python
+# threads at once (numba's default threading layer is not).
+_deposit_serial = jit(nopython=True, nogil=True)(getattr(_deposit, 'py_func',
+                                                         _deposit))
+_deposit_levels_serial = jit(nopython=True, nogil=True)(
+    getattr(_deposit_levels, 'py_func', _deposit_levels))
+
+def _positions(a):
+    a = numpy.asarray(a)
+    if a.dtype != numpy.float32:
+        return numpy.ascontiguousarray(a, dtype=numpy.float64)
+    return numpy.ascontiguousarray(a)
+
+def scalar_map(y,x,scalar_field,hsml,width,pps,zshape,threads=None):
+    """
+    SPH particle smoothing of 'scalar_field' onto a pps x pps grid of side
+    'width', weighting each particle by scalar_field**2.  Runs on
+    'threads' cores (default: all available to numba), each with its own
+    image buffers of pps**2*16 bytes (see _deposit).
+    """
+    # x and y are reversed with respect to the image axes, as in the
+    # original C implementation (hence the argument order above).
+    if threads is None:
+        threads = NUM_THREADS
+    threads = max(1, min(threads, scalar_field.size))
+    # Single precision positions and smoothing lengths are used as they
+    # are; the scalar field (squared for the weights) and the image are
+    # kept in double precision.
+    x = _positions(x)
+    y = _positions(y)
+    scalar_field = numpy.ascontiguousarray(scalar_field, dtype=numpy.float64)
+    hsml = _positions(hsml)
+    deposit = _deposit_serial if threads == 1 else _deposit
+    zi, nzi = deposit(x, y, scalar_field, hsml, float(width), int(pps),
+                      threads)
+    zi = zi.sum(axis=0).reshape(zshape)
+    nzi = nzi.sum(axis=0).reshape(zshape)
     zi = numpy.where(nzi > 0, zi/nzi, zi)
     return zi
 
-#===============================================================================
-def py_scalar_map(y,x,scalar_field,hsml,width,pps,zshape):
-    zi = numpy.zeros(zshape)
-    nzi = numpy.zeros_like(zi)
-    i_min = (x - hsml + width/2.0) / width*pps
-    i_max = (x + hsml + width/2.0) / width*pps
-    j_min = (y - hsml + width/2.0) / width*pps
-    j_max = (y + hsml + width/2.0) / width*pps
-    weight = scalar_field*scalar_field
-    for n in range(scalar_field.size):
-        for i in xrange(pps):
-            if(i >= i_min[n] and i <= i_max[n]):
-                center_i = -width/2.0 + (i+0.5) * width/pps
-                for j in xrange(pps):
-                    if(j >= j_min[n] and j <= j_max[n]):
-                        center_j = -width/2.0 + (j+0.5) * width/pps
-                        r2 = ((x[n] - center_i)**2
-                              + (y[n] - center_j)**2) / hsml[n] / hsml[n]
-                        if(r2 <= 1.0):
-                            r = numpy.sqrt(r2)
-                            if(r <= 0.5):
-                                W_x = 1.0 - 6.0 * r**2 + 6.0 * r**3
-                            else:
-                                W_x = 2.0 * (1.0 - r)**3
-                            zi[i][j] += weight[n] * scalar_field[n] * W_x
-                            nzi[i][j] += weight[n] * W_x
+def level_maps(x, y, z, scalar_field, hsml, widths, pps, **kwargs):
+    """
+    SPH smoothing of 'scalar_field' onto pps x pps grids of several
+    'widths', all centered on the origin, in a single pass over the
+    particles (see _deposit_levels).  Each image equals the scalar_map of
+    the particles inside its view, with the same orientation.
+    sm: smoothing length factor (default 1.7).
+    depth: view depth as a fraction of the width (default 1, 0 or None
+           for no limit).
+    threads: cores to use (default: all available to numba).
+    Returns one image per width, in the order given.
+    """
+    sm = kwargs.pop('sm', 1.7)
+    depth = kwargs.pop('depth', 1.0) or 0.
+    threads = kwargs.pop('threads', None)
+    if threads is None:
+        threads = NUM_THREADS
+    threads = max(1, min(threads, scalar_field.size))
+    widths = numpy.asarray(widths, dtype=numpy.float64)
+    order = numpy.argsort(widths)[::-1]
+    deposit = _deposit_levels_serial if threads == 1 else _deposit_levels
+    # x and y are swapped, as in scalar_map.
+    zi, nzi = deposit(_positions(y), _positions(x), _positions(z),
+                      numpy.ascontiguousarray(scalar_field,
+                                              dtype=numpy.float64),
+                      _positions(hsml), widths[order], int(pps), float(sm),
+                      float(depth), threads)
+    zi = zi.sum(axis=0)
+    nzi = nzi.sum(axis=0)
     zi = numpy.where(nzi > 0, zi/nzi, zi)
-    return zi
+    images = [None] * widths.size
+    for level, i in enumerate(order):
+        images[i] = zi[level]
+    return images
 
 #===============================================================================
-@jit(nopython=True, nogil=True)
-def numba_loop(y,x,scalar_field,hsml,zi,nzi,weight,npart,width,pps,i_min,i_max,j_min,j_max):
-    for n in xrange(npart):
-        for i in xrange(pps):
-            if(i >= i_min[n] and i <= i_max[n]):
-                center_i = -width/2.0 + (i+0.5) * width/pps
-                for j in xrange(pps):
-                    if(j >= j_min[n] and j <= j_max[n]):
-                        center_j = -width/2.0 + (j+0.5) * width/pps
-                        r2 = ((x[n] - center_i)**2
-                              + (y[n] - center_j)**2) / hsml[n] / hsml[n]
-                        if(r2 <= 1.0):
-                            r = numpy.sqrt(r2)
-                            if(r <= 0.5):
-                                W_x = 1.0 - 6.0 * r**2 + 6.0 * r**3
-                            else:
-                                W_x = 2.0 * (1.0 - r)**3
-                            zi[i][j] += weight[n] * scalar_field[n] * W_x
-                            nzi[i][j] += weight[n] * W_x
-    return zi, nzi
-def numba_scalar_map(y,x,scalar_field,hsml,width,pps,zshape):
+# Particle data of the tiled_map in progress, inherited by forked workers.
+_tile_particles = None
+
+def _render_tile(task):
+    """
+    Worker for tiled_map: render one tile, normalized.
+    """
+    i0, j0, ni, nj, begin, end = task
+    x, y, scalar_field, hsml, members, width, pps = _tile_particles
+    zi, nzi = _deposit_tile(x, y, scalar_field, hsml,
+                            numpy.array(members[begin:end]), width, pps,
+                            i0, j0, ni, nj)
+    return i0, j0, numpy.where(nzi > 0, zi/nzi, zi)
+
+def _tile_members(x, y, hsml, width, pps, tile, chunk_size):
+    """
+    Assign particles, chunk_size at a time, to the tile x tile pixel
+    tiles of a pps x pps grid whose pixels their smoothing kernel may
+    touch (with one pixel to spare).  Yields, for each chunk, the tile
+    numbers and particle rows of its assignments, ordered by tile and
+    then by row.
+    """
+    ntiles = -(-pps // tile)
+    for start in xrange(0, x.size, chunk_size):
+        xs = x[start:start+chunk_size].astype(numpy.float64)
+        ys = y[start:start+chunk_size].astype(numpy.float64)
+        hs = hsml[start:start+chunk_size].astype(numpy.float64)
+        bounds = []
+        for pos in [xs, ys]:
+            lo = numpy.trunc((pos - hs + width/2.0) / width*pps) - 1
+            hi = numpy.trunc((pos + hs + width/2.0) / width*pps) + 1
+            bounds.append((lo, hi))
+        (ilo, ihi), (jlo, jhi) = bounds
+        inside = numpy.flatnonzero((ihi >= 0) & (ilo <= pps-1) &
+                                   (jhi >= 0) & (jlo <= pps-1))
+        ti0, ti1, tj0, tj1 = [(numpy.clip(b[inside], 0, pps-1) // tile)
+                              .astype(numpy.intp)
+                              for b in [ilo, ihi, jlo, jhi]]
+        rows = inside + start
+        ids = []
+        members = []
+        # Most particles touch at most 2 x 2 tiles; the rest are few and
+        # assigned one by one.
+        large = (ti1 - ti0 > 1) | (tj1 - tj0 > 1)
+        for n in numpy.flatnonzero(large):
+            ti, tj = numpy.mgrid[ti0[n]:ti1[n]+1, tj0[n]:tj1[n]+1]
+            ids.append((ti * ntiles + tj).ravel())
+            members.append(numpy.repeat(rows[n], ti.size))
+        small = ~large
+        for di in [0, 1]:
+            for dj in [0, 1]:
+                sel = numpy.flatnonzero(small & (ti0 + di <= ti1) &
+                                        (tj0 + dj <= tj1))
+                ids.append((ti0[sel] + di) * ntiles + tj0[sel] + dj)
+                members.append(rows[sel])
+        ids = numpy.concatenate(ids)
+        members = numpy.concatenate(members)
+        order = numpy.lexsort((members, ids))
+        yield ids[order], members[order]
+
+def tiled_map(y,x,scalar_field,hsml,width,pps,**kwargs):
+    """
+    Tiled version of scalar_map for very large images.  The grid is split
+    into tiles, and particles are assigned to every tile their smoothing
+    kernel overlaps.  The assignments are streamed, a chunk of particles
+    at a time, into a temporary file sorted by tile (a counting sort:
+    one pass to count, one to place).  Tiles are then rendered
+    independently in worker processes, each reading its own slice of
+    that file, and stitched together.  Besides the image, which can be
+    written straight to disk, memory use is one tile per process and one
+    chunk of particles, so the particle arrays (x, y, scalar_field, hsml)
+    may be memory maps larger than memory (see Simulation memmap and
+    field_cache); they are used in their own precision.  The result
+    equals scalar_map's on a single core.
+
+    tile: tile size in pixels (default 1024).
+    nprocs: number of worker processes (default: number of cpus).
+    chunk_size: particles assigned to tiles at a time.
+    output: if set, write the image to this .npy file, and return it as
+            a memory map of that file.
+    tmpdir: directory for the tile assignments (default: the system's
+            temporary directory).
+    """
+    tile = kwargs.pop('tile', 1024)
+    nprocs = kwargs.pop('nprocs', mp.cpu_count())
+    chunk_size = kwargs.pop('chunk_size', 2**20)
+    output = kwargs.pop('output', None)
+    tmpdir = kwargs.pop('tmpdir', None)
+    global _tile_particles
+    x = _positions(x)
+    y = _positions(y)
+    scalar_field = numpy.asarray(scalar_field)
+    if scalar_field.dtype.kind != 'f':
+        scalar_field = scalar_field.astype(numpy.float64)
+    scalar_field = numpy.ascontiguousarray(scalar_field)
+    hsml = _positions(hsml)
+    width = float(width)
+    pps = int(pps)
+    ntiles = -(-pps // tile)
+
+    counts = numpy.zeros(ntiles**2, dtype=numpy.int64)
+    for ids, rows in _tile_members(x, y, hsml, width, pps, tile, chunk_size):
+        counts += numpy.bincount(ids, minlength=ntiles**2)
+    offsets = numpy.concatenate(([0], numpy.cumsum(counts)))
+    row_type = numpy.int32 if x.size < 2**31 else numpy.int64
+    with tempfile.NamedTemporaryFile(dir=tmpdir,
+                                     prefix='gadfly_tiles_') as f:
+        members = numpy.memmap(f, dtype=row_type, mode='w+',
+                               shape=(max(offsets[-1], 1),))
+        fill = offsets[:-1].copy()
+        for ids, rows in _tile_members(x, y, hsml, width, pps, tile,
+                                       chunk_size):
+            found = numpy.bincount(ids, minlength=ntiles**2)
+            first = numpy.concatenate(([0], numpy.cumsum(found)))[ids]
+            members[fill[ids] + numpy.arange(ids.size) - first] = rows
+            fill += found
+        members.flush()
+
+        if output:
+            image = numpy.lib.format.open_memmap(output, mode='w+',
+                                                 dtype=numpy.float64,
+                                                 shape=(pps, pps))
+        else:
+            image = numpy.zeros((pps, pps))
+        tasks = [((k // ntiles) * tile, (k % ntiles) * tile,
+                  min(tile, pps - (k // ntiles) * tile),
+                  min(tile, pps - (k % ntiles) * tile),
+                  offsets[k], offsets[k+1])
+                 for k in numpy.flatnonzero(counts)]
+        # Compile the kernel before forking, so workers share it.
+        _deposit_tile(x, y, scalar_field, hsml,
+                      numpy.arange(0, dtype=row_type), width, pps, 0, 0, 1, 1)
+        _tile_particles = (x, y, scalar_field, hsml, members, width, pps)
+        try:
+            if nprocs > 1 and len(tasks) > 1:
+                pool = mp.Pool(min(nprocs, len(tasks)))
+                try:
+                    for i0, j0, zi in pool.imap_unordered(_render_tile,
+                                                          tasks):
+                        image[i0:i0+zi.shape[0], j0:j0+zi.shape[1]] = zi
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for task in tasks:
+                    i0, j0, zi = _render_tile(task)
+                    image[i0:i0+zi.shape[0], j0:j0+zi.shape[1]] = zi
+        finally:
+            _tile_particles = None
+            del members
+    if output:
+        image.flush()
+    return image
+
+#===============================================================================
+def py_scalar_map(y,x,scalar_field,hsml,width,pps,zshape):
+    """
+    Pure numpy version of scalar_map.  Each particle's kernel is evaluated
+    over its footprint on the grid in one array operation.
+    """
     zi = numpy.zeros(zshape)
     nzi = numpy.zeros_like(zi)
-    i_min = (x - hsml + width/2.0) / width*pps
-    i_max = (x + hsml + width/2.0) / width*pps
-    j_min = (y - hsml + width/2.0) / width*pps
-    j_max = (y + hsml + width/2.0) / width*pps
+    # Pixel bounds are truncated toward zero, as in the compiled kernel.
+    i_min = numpy.fmax(numpy.trunc((x - hsml + width/2.0) / width*pps), 0)
+    i_max = numpy.fmin(numpy.trunc((x + hsml + width/2.0) / width*pps), pps-1)
+    j_min = numpy.fmax(numpy.trunc((y - hsml + width/2.0) / width*pps), 0)
+    j_max = numpy.fmin(numpy.trunc((y + hsml + width/2.0) / width*pps), pps-1)
+    centers = -width/2.0 + (numpy.arange(pps)+0.5) * width/pps
     weight = scalar_field*scalar_field
-    npart = scalar_field.size
-    zi,nzi = numba_loop(y,x,hsml,scalar_field,zi,nzi,weight,
-                        npart,width,pps,i_min,i_max,j_min,j_max)
+    for n in xrange(scalar_field.size):
+        if i_max[n] < i_min[n] or j_max[n] < j_min[n]:
+            continue
+        i = slice(int(i_min[n]), int(i_max[n])+1)
+        j = slice(int(j_min[n]), int(j_max[n])+1)
+        r2 = (numpy.square(x[n] - centers[i])[:,numpy.newaxis]
+              + numpy.square(y[n] - centers[j])) / hsml[n] / hsml[n]
+        r = numpy.sqrt(r2)
+        W_x = numpy.where(r <= 0.5, 1.0 - 6.0 * r**2 + 6.0 * r**3,
+                          2.0 * (1.0 - r)**3)
+        W_x[r2 > 1.0] = 0.
+        zi[i,j] += weight[n] * scalar_field[n] * W_x
+        nzi[i,j] += weight[n] * W_x
     zi = numpy.where(nzi > 0, zi/nzi, zi)
     return zi
 
+# Former name of the numba implementation.
+numba_scalar_map = scalar_map
+
 #===============================================================================
-def set_view(view, xyz, **kwargs):
+def view_matrix(view, xyz=None, **kwargs):
+    """
+    Return the rotation matrix for a view (see coordinates.view_matrix).
+    The face-on view ('face') looks down the angular momentum of the
+    particles denser than dens_lim, and requires positions (xyz),
+    velocity and density.
+    """
+    if view != 'face':
+        return coordinates.view_matrix(view)
     uvw = kwargs.pop('velocity', None)
     dens = kwargs.pop('density', None)
     mass = kwargs.pop('mass', None)
     dlim = kwargs.pop('dens_lim', 1e9)
-    if view ==  'face':
-        if uvw is None or dens is None:
-            raise KeyError("setting face-on view requires density, "\
-                           "position and velocity!")
-        pos_vel = pandas.concat([xyz,uvw,dens,mass], axis=1)
-        pos_vel = pos_vel[pos_vel[dens.name] > dlim]
-        pos = pos_vel[['x', 'y', 'z']]
-        vel = pos_vel[['u', 'v', 'w']]
-        try:
-            mass = pos_vel[mass.name]
-        except AttributeError:
-            pass
-        axis, angle = analyze.faceon_rotation(pos, vel, mass)
-        xyz = coordinates.rotate(xyz, axis, angle)
-        uvw = coordinates.rotate(uvw, axis, angle)
-    elif view == 'xy':
+    if xyz is None or uvw is None or dens is None:
+        raise KeyError("setting face-on view requires density, "\
+                       "position and velocity!")
+    pos_vel = pandas.concat([xyz,uvw,dens,mass], axis=1)
+    pos_vel = pos_vel[pos_vel[dens.name] > dlim]
+    pos = pos_vel[['x', 'y', 'z']]
+    vel = pos_vel[['u', 'v', 'w']]
+    try:
+        mass = pos_vel[mass.name]
+    except AttributeError:
         pass
-    elif view == 'xz':
-        xyz = coordinates.rotate(xyz,'x', numpy.pi/2)
-        if uvw is not None:
-            uvw = coordinates.rotate(uvw,'x', numpy.pi/2)
-    elif view == 'yz':
-        xyz = coordinates.rotate(xyz,'z', numpy.pi/2)
-        xyz = coordinates.rotate(xyz,'x', numpy.pi/2)
-        if uvw is not None:
-            uvw = coordinates.rotate(uvw,'z', numpy.pi/2)
-            uvw = coordinates.rotate(uvw,'x', numpy.pi/2)
-    else:
-        for rot in view:
-            xyz = coordinates.rotate(xyz, rot[0], rot[1])
-        if uvw is not None:
-            for rot in view:
-                uvw = coordinates.rotate(uvw, rot[0], rot[1])
-    if uvw is not None:
-        return xyz, uvw
-    else:
-        return xyz
+    axis, angle = analyze.faceon_rotation(pos, vel, mass)
+    return coordinates.rotation_matrix(axis, angle)
+
+def set_view(view, xyz, **kwargs):
+    """
+    Rotate positions (and velocity, if given) in place to a view: 'xy',
+    'xz', 'yz', 'face', or a sequence of (axis, angle) rotations.  All
+    rotations are composed into one matrix, applied once.
+    """
+    uvw = kwargs.get('velocity', None)
+    rot = view_matrix(view, xyz, **kwargs)
+    if uvw is None:
+        return coordinates.transform(xyz, rot)
+    if isinstance(xyz, numpy.ndarray):
+        return coordinates.transform(xyz, rot), coordinates.transform(uvw, rot)
+    # Rotate positions and velocities together as one (N,6) block.
+    block = numpy.hstack((xyz.values, uvw.values))
+    coordinates.transform(block, rot)
+    xyz[xyz.columns] = block[:, :3]
+    uvw[uvw.columns] = block[:, 3:]
+    return xyz, uvw
 
 def trim_view(width, x, y, z, *args, **kwargs):
     depth = kwargs.pop('depth',1.0)
@@ -248,55 +458,270 @@ def trim_view(width, x, y, z, *args, **kwargs):
     print ' y:: max: %.3e min: %.3e' %(y.max(),y.min())
     return [x,y,z]+arrs
 
-def build_grid(width,pps):
+def build_grid(width,pps,sparse=False):
     xres = yres = width/pps
     xvals = numpy.arange(-width/2,width/2,xres)
     yvals = numpy.arange(-width/2,width/2,yres)
-    return numpy.meshgrid(xvals,yvals)
+    return numpy.meshgrid(xvals,yvals,sparse=sparse)
+
+def parse_scale(scale):
+    """
+    Split an image scale such as '10pc' into its width and length unit.
+    """
+    width = float("".join(ch if ch.isdigit() or ch == '.' else ""
+                          for ch in scale))
+    unit = "".join(ch if not (ch.isdigit() or ch == '.') else ""
+                   for ch in scale)
+    return width, unit
 
 def project(snapshot, scale, view, **kwargs):
+    """
+    Project the gas number density of 'snapshot' onto a pps x pps grid
+    'scale' wide (e.g. '10pc'), seen from 'view' (see set_view).
+    pps (default 500), sm (smoothing length factor, default 1.7),
+    shiftx/shifty/shiftz, dens_lim, depth (as a fraction of the width,
+    default 1), imscale (default 'log').
+    tile: if set, render in tiles of this many pixels with tiled_map, on
+          nprocs processes; the grid xi, yi is then returned sparse
+          (broadcastable to the full grid) to save memory.  This bounds
+          the memory of the rendering only: project still loads, centers
+          and rotates the particles in memory.  For snapshots larger
+          than memory, call tiled_map on memory-mapped arrays.
+    Remaining kwargs are used to center the box (see analyze.center_box).
+    Returns the grid and the image: xi, yi, zi.
+    """
     pps = kwargs.pop('pps',500)
     sm = kwargs.pop('sm',1.7)
     shiftx = kwargs.pop('shiftx',None)
     shifty = kwargs.pop('shifty',None)
     shiftz = kwargs.pop('shiftz',None)
     dens_lim = kwargs.pop('dens_lim', None)
-    boxsize = float("".join(ch if ch.isdigit() else "" for ch in scale))
-    unit = "".join(ch if not ch.isdigit() else "" for ch in scale)
+    depth = kwargs.pop('depth', 1.0)
+    imscale = kwargs.pop('imscale','log')
+    tile = kwargs.pop('tile', None)
+    nprocs = kwargs.pop('nprocs', mp.cpu_count())
+    boxsize, unit = parse_scale(scale)
     dens = snapshot.gas.get_number_density()
     xyz = snapshot.gas.get_coords(unit)
-    uvw = snapshot.gas.get_velocities()
-    hsml = snapshot.gas.get_smoothing_length(unit)
+    hsml = snapshot.gas.get_smoothing_length(unit).values.copy()
 
     print 'Calculating...'
-    xyz = analyze.center_box(xyz, velocity=uvw, density=dens, **kwargs)
-    xyz = set_view(view, xyz)
-    x = xyz.x
-    y = xyz.y
-    z = xyz.z
+    xyz = analyze.center_box(xyz, density=dens, **kwargs)
+    if view == 'face':
+        uvw = snapshot.gas.get_velocities()
+        rot = view_matrix(view, xyz, velocity=uvw, density=dens)
+    else:
+        rot = view_matrix(view)
+    x, y, z = coordinates.transform(xyz.values.copy(), rot).T
     if shiftx:
         x += shiftx
     if shifty:
         y += shifty
     if shiftz:
         z += shiftz
-    snapshot.update_sink_coordinates(x,y,z)
-    # Artificially shrink sink smoothing lengths.
-    for s in snapshot.sinks:
-        hsml[s.index] *= .5
-    data = snap.gas['x', 'y', 'z', 'ndensity', 'smoothing_length'].copy(deep=True)
-    data = trim_view(boxsize, data, **kwargs)
+    if hasattr(snapshot, 'sinks'):
+        snapshot.update_sink_coordinates(x,y,z)
+        # Artificially shrink sink smoothing lengths.  Rows are positions
+        # in the file, so sinks are looked up by particle ID.
+        rows = snapshot.gas.rows_for_ids([s.pid for s in snapshot.sinks])
+        hsml[rows[rows >= 0]] *= .5
+    x,y,z,scalar,hsml = trim_view(boxsize, x, y, z, dens.values, hsml,
+                                  depth=depth)
     if dens_lim:
-        arrs = [scalar,x,y,z,hsml]
-        scalar,x,y,z,hsml = analyze.data_slice(scalar > dens_lim, *arrs)
+        keep = scalar > dens_lim
+        scalar,x,y,z,hsml = [arr[keep] for arr in [scalar,x,y,z,hsml]]
     hsml = numpy.fmax(sm * hsml, boxsize/pps/2)
-    xi,yi = build_grid(boxsize,pps)
-    zi = scalar_map(x,y,scalar,hsml,boxsize,pps,xi.shape)
-    print '%s:: min: %.3e max: %.3e' %(loadable, zi.min(),zi.max())
-    imscale = kwargs.pop('imscale','log')
+    if tile:
+        xi,yi = build_grid(boxsize,pps,sparse=True)
+        zi = tiled_map(x,y,scalar,hsml,boxsize,pps,tile=tile,nprocs=nprocs)
+    else:
+        xi,yi = build_grid(boxsize,pps)
+        zi = scalar_map(x,y,scalar,hsml,boxsize,pps,xi.shape)
+    print 'ndensity:: min: %.3e max: %.3e' %(zi.min(),zi.max())
     if imscale == 'log':
         zi = numpy.log10(zi)
-        print 'log(%s):: min: %.3e max: %.3e' %(loadable, zi.min(),zi.max())
+        print 'log(ndensity):: min: %.3e max: %.3e' %(zi.min(),zi.max())
     else:
         print 'Returning raw (non-log) values!'
     return xi,yi,zi
+
+def project_pyramid(snapshot, scales, view='xy', **kwargs):
+    """
+    Project the gas number density of 'snapshot' at several nested scales
+    (e.g. ['5592pc', '1000pc', '100pc', '10pc']) at once.  The particles
+    are loaded, centered and rotated once, and deposited into all scales
+    in a single pass (see level_maps).
+    view: see set_view (default 'xy').
+    pps (default 500), sm (default 1.7), depth (default 1), imscale
+    (default 'log') and threads are as for project.  Remaining kwargs
+    are used to center the box (see analyze.center_box).
+    Returns a list of (xi, yi, zi), one per scale, as from project.
+    """
+    pps = kwargs.pop('pps', 500)
+    sm = kwargs.pop('sm', 1.7)
+    depth = kwargs.pop('depth', 1.0)
+    imscale = kwargs.pop('imscale', 'log')
+    threads = kwargs.pop('threads', None)
+    widths, units = zip(*[parse_scale(scale) for scale in scales])
+    unit = units[0]
+    gas = snapshot.gas
+    dens = gas.get_number_density()
+    xyz = gas.get_coords(unit)
+    hsml = gas.get_smoothing_length(unit)
+    # Image widths in the coordinate unit.
+    widths = [gas.units.convert_units(w, u, unit)
+              for w, u in zip(widths, units)]
+
+    print 'Calculating...'
+    xyz = analyze.center_box(xyz, density=dens, **kwargs)
+    if view == 'face':
+        uvw = gas.get_velocities()
+        rot = view_matrix(view, xyz, velocity=uvw, density=dens)
+    else:
+        rot = view_matrix(view)
+    x, y, z = coordinates.transform(xyz.values.copy(), rot).T
+    images = level_maps(x, y, z, dens.values, hsml.values, widths, pps,
+                        sm=sm, depth=depth, threads=threads)
+    pyramid = []
+    for scale, width, zi in zip(scales, widths, images):
+        xi, yi = build_grid(width, pps)
+        print '%s ndensity:: min: %.3e max: %.3e' %(scale, zi.min(), zi.max())
+        if imscale == 'log':
+            with numpy.errstate(divide='ignore'):
+                zi = numpy.log10(zi)
+        pyramid.append((xi, yi, zi))
+    return pyramid
+
+#===============================================================================
+class RotationSequence(object):
+    """
+    Gas number density projections of a snapshot at several scales, for a
+    sequence of rotation angles (e.g. the frames of a rotation movie).
+    Particle data are loaded, centered and culled to the largest scale
+    once; each frame then only rotates the remaining particles and
+    deposits them into all scales in one pass (see level_maps).
+
+    snapshot: snapshot.File.
+    scales: image widths, e.g. ['5592pc', '1000pc', '10pc', '100pc'].
+    angles: rotation angles in radians, one per frame.
+    axis: rotation axis (default 'y').
+    view: view to rotate from (default 'xy', see set_view).
+    pps (default 500), sm (default 1.7), depth (default 1) and imscale
+    (default 'log') are as for project.  Remaining kwargs are used to
+    center the box (see analyze.center_box).
+    """
+    def __init__(self, snapshot, scales, angles, **kwargs):
+        self.scales = list(scales)
+        self.angles = numpy.asarray(angles, dtype=numpy.float64)
+        self.axis = kwargs.pop('axis', 'y')
+        self.view = kwargs.pop('view', 'xy')
+        self.pps = kwargs.pop('pps', 500)
+        self.sm = kwargs.pop('sm', 1.7)
+        self.depth = kwargs.pop('depth', 1.0)
+        self.imscale = kwargs.pop('imscale', 'log')
+
+        widths, units = zip(*[parse_scale(scale) for scale in self.scales])
+        unit = units[0]
+        gas = snapshot.gas
+        dens = gas.get_number_density()
+        xyz = gas.get_coords(unit)
+        hsml = gas.get_smoothing_length(unit)
+        # Image widths in the coordinate unit.
+        self.widths = [gas.units.convert_units(w, u, unit)
+                       for w, u in zip(widths, units)]
+        print 'Calculating...'
+        xyz = analyze.center_box(xyz, density=dens, **kwargs).values
+        # Only particles inside the sphere circumscribing the largest
+        # image volume can appear in any frame.
+        keep = slice(None)
+        if self.depth:
+            half = max(self.widths) / 2
+            radius = half * numpy.sqrt(2 + self.depth**2)
+            keep = numpy.einsum('ij,ij->i', xyz, xyz) < radius**2
+        self._xyz = numpy.ascontiguousarray(xyz[keep])
+        self._scalar = dens.values[keep]
+        self._hsml = hsml.values[keep]
+        print self._scalar.size, 'particles in view.'
+
+    def __len__(self):
+        return self.angles.size
+
+    def render(self, frame, threads=None):
+        """
+        Return the images of frame number 'frame', one per scale.
+        threads: cores used for depositing (default: all).
+        """
+        rot = numpy.dot(coordinates.view_matrix(self.view),
+                        coordinates.rotation_matrix(self.axis,
+                                                    self.angles[frame]))
+        xyz = numpy.dot(self._xyz, rot.astype(self._xyz.dtype))
+        x, y, z = xyz.T
+        images = level_maps(x, y, z, self._scalar, self._hsml, self.widths,
+                            self.pps, sm=self.sm, depth=self.depth,
+                            threads=threads)
+        if self.imscale == 'log':
+            with numpy.errstate(divide='ignore'):
+                images = [numpy.log10(zi) for zi in images]
+        return images
+
+    def frames(self, threads=None):
+        """
+        Render all frames, several at a time, yielding (frame number,
+        images) in order as they become available.  At most two frames
+        per thread are rendered ahead of the one being yielded.
+        threads: number of frames rendered concurrently (default: all
+                 cores); each frame is deposited on a single core.
+        """
+        nthreads = max(1, min(threads or NUM_THREADS, len(self)))
+        tasks = Queue.Queue()
+        done = Queue.Queue()
+        stop = threading.Event()
+        def work():
+            while True:
+                frame = tasks.get()
+                if frame is None or stop.is_set():
+                    return
+                try:
+                    done.put((frame, self.render(frame, threads=1), None))
+                except Exception as e:
+                    done.put((frame, None, e))
+        workers = [threading.Thread(target=work) for t in range(nthreads)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        submitted = min(2 * nthreads, len(self))
+        for frame in range(submitted):
+            tasks.put(frame)
+        finished = {}
+        try:
+            for frame in range(len(self)):
+                while frame not in finished:
+                    n, images, error = done.get()
+                    if error is not None:
+                        raise error
+                    finished[n] = images
+                if submitted < len(self):
+                    tasks.put(submitted)
+                    submitted += 1
+                yield frame, finished.pop(frame)
+        finally:
+            stop.set()
+            for worker in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join()
+
+    def save(self, path, prefix='frame', threads=None):
+        """
+        Render all frames, writing each to path/<prefix>_NNNN.npy (an
+        array of one image per scale) as soon as it is finished.
+        Returns the file names.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        filenames = []
+        for frame, images in self.frames(threads):
+            fname = os.path.join(path, '%s_%04d.npy' %(prefix, frame))
+            numpy.save(fname, numpy.array(images))
+            filenames.append(fname)
+        return filenames
@@ -26,10 +26,10 @@ def setup_gadfly():
             'Topic :: Scientific/Engineering :: Physics'
         ],
         # zip_safe=False,
-        packages=['gadfly'], # ['gadfly', 'gadfly.more'],
+        packages=['gadfly', 'gadfly.bench'],
         package_dir={
             'gadfly' : 'gadfly',
-            # 'gadfly.more' : 'gadfly/more',
+            'gadfly.bench' : 'gadfly/bench',
         },
     )
     return
@@ -0,0 +1,70 @@
+# test_analyze.py
+# Jacob Hummel
+"""
+Tests of gadfly.analyze.
+"""
+import unittest
+import numpy
+import pandas
+
+from gadfly import analyze
+
+class TestRadialProfile(unittest.TestCase):
+    def test_all_particles_binned(self):
+        """
+        Every particle with 0 < r <= rmax lies in a shell with log bins,
+        including the innermost one, and Menc is the sum of the shells.
+        """
+        rng = numpy.random.RandomState(0)
+        r = numpy.concatenate(([0., 0.1, 0.5, 1., 2.],
+                               rng.uniform(0, 2, 100)))
+        mass = rng.uniform(1, 2, r.size)
+        for bins in [1, 3, 20]:
+            profile = analyze.radial_profile(r, mass, bins=bins)
+            inside = (r > 0) & (r <= r.max())
+            self.assertEqual(profile.npart.sum(), inside.sum())
+            numpy.testing.assert_allclose(profile.Mshell.sum(),
+                                          mass[inside].sum())
+            numpy.testing.assert_allclose(profile.Menc - mass[r == 0].sum(),
+                                          numpy.cumsum(profile.Mshell))
+
+    def test_random_edges(self):
+        """
+        No particle with 0 < r <= rmax is lost to rounding of the bin
+        edges, for random radii and numbers of bins.
+        """
+        rng = numpy.random.RandomState(1)
+        for trial in range(500):
+            r = rng.uniform(0, 10, rng.randint(2, 50)) * 10.**rng.randint(-3, 4)
+            bins = rng.randint(1, 60)
+            for log in [True, False]:
+                profile = analyze.radial_profile(r, numpy.ones(r.size),
+                                                 bins=bins, log=log)
+                self.assertEqual(profile.npart.sum(), r.size)
+        profile = analyze.radial_profile([0.3, 1, 3], numpy.ones(3), bins=1)
+        self.assertEqual(profile.npart.sum(), 3)
+
+    def test_linear_bins_include_origin(self):
+        r = numpy.array([0., 0.5, 1.])
+        profile = analyze.radial_profile(r, numpy.ones(3), bins=2, log=False)
+        self.assertEqual(list(profile.npart), [2, 1])
+
+class TestFindCenter(unittest.TestCase):
+    def test_max_with_gaps_in_index(self):
+        """
+        'max' centering picks the densest particle when the index labels
+        (file rows, after refinement) are not positions.
+        """
+        rng = numpy.random.RandomState(0)
+        index = numpy.arange(0, 300, 3)
+        pos_vel = pandas.DataFrame(rng.normal(size=(100, 6)), index=index,
+                                   columns=['x', 'y', 'z', 'u', 'v', 'w'])
+        density = pandas.Series(rng.lognormal(size=100), index=index)
+        center = analyze.find_center(pos_vel, density, centering='max',
+                                     verbose=False)
+        expected = pos_vel.values[density.values.argmax()]
+        numpy.testing.assert_array_equal(center[['x', 'y', 'z']].values,
+                                         expected[:3])
+
+if __name__ == '__main__':
+    unittest.main()
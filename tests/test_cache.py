@@ -0,0 +1,78 @@
+# test_cache.py
+# Jacob Hummel
+"""
+Tests of the on-disk field cache.
+"""
+import os
+import glob
+import shutil
+import tempfile
+import unittest
+import numpy
+
+import gadfly
+from gadfly.bench import write_snapshot
+
+class TestFieldCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='gadfly_test_')
+        write_snapshot(self.path+'/snapshot_000.hdf5', 1000, 1000,
+                       double=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def load_x(self, **simargs):
+        sim = gadfly.Simulation(self.path, **simargs)
+        snap = sim.load_snapshot(0)
+        try:
+            return snap.gas['x'].values.copy()
+        finally:
+            snap.close()
+
+    def test_dtype_in_key(self):
+        """
+        A field cached at float32 is not reused for a float64 read.
+        """
+        single = self.load_x(field_cache=True, dtype='float32')
+        double = self.load_x(field_cache=True, dtype='float64')
+        expected = self.load_x(dtype='float64')
+        self.assertEqual(single.dtype, numpy.float32)
+        self.assertEqual(double.dtype, numpy.float64)
+        numpy.testing.assert_array_equal(double, expected)
+        self.assertFalse(numpy.array_equal(double, single))
+
+    def cached(self, field):
+        return glob.glob(self.path+'/field_cache/snapshot_000/PartType0/*/'
+                         +field+'-*.npy')
+
+    def test_stored_fields_not_cached(self):
+        """
+        Fields needing no conversion are mapped from the snapshot, not
+        copied into the cache; converted fields are cached.
+        """
+        sim = gadfly.Simulation(self.path, field_cache=True)
+        snap = sim.load_snapshot(0)
+        snap.gas.load_data('coordinates', 'particleIDs')
+        snap.close()
+        self.assertEqual(len(self.cached('coordinates')), 1)
+        self.assertEqual(self.cached('particleIDs'), [])
+
+    def test_stale_entries_deleted(self):
+        """
+        Entries of a rewritten snapshot are deleted when new ones are
+        written.
+        """
+        self.load_x(field_cache=True)
+        old = self.cached('coordinates')
+        self.assertEqual(len(old), 1)
+        snapfile = self.path+'/snapshot_000.hdf5'
+        stat = os.stat(snapfile)
+        os.utime(snapfile, (stat.st_atime, stat.st_mtime + 10))
+        self.load_x(field_cache=True)
+        new = self.cached('coordinates')
+        self.assertEqual(len(new), 1)
+        self.assertNotEqual(new, old)
+
+if __name__ == '__main__':
+    unittest.main()
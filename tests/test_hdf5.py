@@ -0,0 +1,77 @@
+# test_hdf5.py
+# Jacob Hummel
+"""
+Tests of the PartType particle frames.
+"""
+import shutil
+import tempfile
+import unittest
+import numpy
+
+import gadfly
+from gadfly.bench import write_snapshot
+
+class TestDerivedFields(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='gadfly_test_')
+        write_snapshot(self.path+'/snapshot_000.hdf5', 1000, 1000)
+        self.snap = gadfly.Simulation(self.path).load_snapshot(0)
+
+    def tearDown(self):
+        self.snap.close()
+        shutil.rmtree(self.path)
+
+    def test_access_checks_units(self):
+        """
+        Attribute and item access recalculate a derived column after the
+        units it depends on change, like get_derived.
+        """
+        gas = self.snap.gas
+        calls = []
+        calculate = gas.calculate_number_density
+        def counted():
+            calls.append(1)
+            return calculate()
+        vars(gas)['calculate_number_density'] = counted
+        gas.ndensity
+        gas['ndensity']
+        self.assertEqual(len(calls), 1)
+        units = gas.units
+        units.densities['alt'] = units.densities['cgs']
+        units.set_density('alt')
+        gas.ndensity
+        self.assertEqual(len(calls), 2)
+        units.set_density('cgs')
+        gas['ndensity']
+        self.assertEqual(len(calls), 3)
+        gas[['ndensity', 'x']]
+        self.assertEqual(len(calls), 3)
+
+class TestParticleIDs(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='gadfly_test_')
+        write_snapshot(self.path+'/snapshot_000.hdf5', 1000, 1000)
+        self.snap = gadfly.Simulation(self.path).load_snapshot(0)
+
+    def tearDown(self):
+        self.snap.close()
+        shutil.rmtree(self.path)
+
+    def test_rows_for_ids(self):
+        gas = self.snap.gas
+        ids = gas['particleIDs'].values
+        query = numpy.array([ids[5], ids[0], ids.max() + 1], dtype=ids.dtype)
+        self.assertEqual(list(gas.rows_for_ids(query)), [5, 0, -1])
+        self.assertEqual(list(gas.rows_for_ids([int(ids[3])])), [3])
+        self.assertEqual(gas.rows_for_ids([]).size, 0)
+
+    def test_invalid_ids(self):
+        """
+        Negative or non-integer IDs raise instead of wrapping around.
+        """
+        gas = self.snap.gas
+        for ids in [[-1], [1.5], numpy.array([3.], dtype=numpy.float64)]:
+            self.assertRaises(ValueError, gas.rows_for_ids, ids)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# test_sim.py
+# Jacob Hummel
+"""
+Tests of gadfly.Simulation.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import gadfly
+from gadfly.bench import write_snapshot
+
+class TestSnapshotCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='gadfly_test_')
+        write_snapshot(self.path+'/snapshot_000.hdf5', 1000, 1000)
+        self.sim = gadfly.Simulation(self.path, cache_bytes=2**30)
+
+    def tearDown(self):
+        self.sim.clear_cache()
+        shutil.rmtree(self.path)
+
+    def test_units_in_key(self):
+        """
+        A snapshot cached under one unit system is not returned after the
+        units change.
+        """
+        snap = self.sim.load_snapshot(0)
+        self.assertIs(self.sim.load_snapshot(0), snap)
+        self.sim.units.set_mass('g')
+        self.assertIsNot(self.sim.load_snapshot(0), snap)
+        self.sim.units.set_mass('solar')
+        self.assertIs(self.sim.load_snapshot(0), snap)
+        self.sim.set_coordinate_system('comoving')
+        self.assertIsNot(self.sim.load_snapshot(0), snap)
+
+    def test_dtype_in_key(self):
+        snap = self.sim.load_snapshot(0)
+        self.sim.dtype = 'float32'
+        self.assertIsNot(self.sim.load_snapshot(0), snap)
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='gadfly_test_')
+        self.pieces = write_snapshot(self.path+'/snapshot_000.hdf5', 1000,
+                                     1000, nfiles=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_any_piece_changed(self):
+        """
+        Rewriting a piece other than the first invalidates the catalog.
+        """
+        sim = gadfly.Simulation(self.path)
+        sim.catalog()
+        reads = []
+        read_header_summary = gadfly.sim.read_header_summary
+        def counted(snapfile):
+            reads.append(snapfile)
+            return read_header_summary(snapfile)
+        gadfly.sim.read_header_summary = counted
+        try:
+            sim.catalog()
+            self.assertEqual(reads, [])
+            last = os.stat(self.pieces[-1])
+            os.utime(self.pieces[-1], (last.st_atime, last.st_mtime + 10))
+            sim.catalog()
+            self.assertEqual(reads, [self.pieces[0]])
+        finally:
+            gadfly.sim.read_header_summary = read_header_summary
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+# test_visualize.py
+# Jacob Hummel
+"""
+Tests of gadfly.visualize.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from gadfly import visualize
+
+class TestTiledMap(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        n = 20000
+        self.x = rng.normal(0, .2, n).astype(numpy.float32)
+        self.y = rng.normal(0, .2, n).astype(numpy.float32)
+        self.scalar = rng.lognormal(size=n).astype(numpy.float32)
+        self.hsml = (rng.lognormal(size=n) * 0.01).astype(numpy.float32)
+        self.hsml[:5] = 0.4
+        self.pps = 150
+        self.expected = visualize.scalar_map(self.x, self.y, self.scalar,
+                                             self.hsml, 1.0, self.pps,
+                                             (self.pps, self.pps), threads=1)
+
+    def test_matches_scalar_map(self):
+        for tile, nprocs in [(32, 1), (50, 2), (1024, 1)]:
+            image = visualize.tiled_map(self.x, self.y, self.scalar,
+                                        self.hsml, 1.0, self.pps, tile=tile,
+                                        nprocs=nprocs, chunk_size=3000)
+            numpy.testing.assert_array_equal(image, self.expected)
+
+    def test_output_file(self):
+        path = tempfile.mkdtemp(prefix='gadfly_test_')
+        try:
+            output = os.path.join(path, 'image.npy')
+            visualize.tiled_map(self.x, self.y, self.scalar, self.hsml, 1.0,
+                                self.pps, tile=40, output=output)
+            numpy.testing.assert_array_equal(numpy.load(output),
+                                             self.expected)
+        finally:
+            shutil.rmtree(path)
+
+if __name__ == '__main__':
+    unittest.main()